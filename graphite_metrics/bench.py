@@ -0,0 +1,651 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import itertools as it, operator as op, functools as ft
+from collections import OrderedDict
+from datetime import datetime
+from time import time, gmtime, strftime
+from random import Random
+from io import open
+import os, sys, json, math, struct, shutil, socket, resource, importlib, threading
+
+import logging
+log = logging.getLogger(__name__)
+
+
+collectors = [ 'irq', 'stats', 'memstats', 'memfrag',
+	'slabinfo', 'cgacct', 'iptables_counts', 'sysstat', 'cron_log' ]
+targets = collectors + ['loop'] # loop -> processors -> carbon sink
+
+page_size = os.sysconf('SC_PAGE_SIZE')
+
+
+class BenchError(Exception): pass
+
+
+class Fixtures(object):
+
+	'''Generated /proc files, cgroup (v1 or v2) hierarchy, canned iptables-save,
+			sadf -j output (or binary sa file) and cron log under a single root directory,
+			at specified scale.
+		Collectors are pointed to these by the config (see "bench.yaml" there)
+			and by redirecting /proc paths, device and systemd service lookups (see install()).
+		Real /proc files can be copied over generated ones (recorded) with record().'''
+
+	proc_files = [ 'interrupts', 'softirqs', 'stat',
+		'vmstat', 'meminfo', 'buddyinfo', 'pagetypeinfo', 'slabinfo' ]
+	softirqs = [ 'HI', 'TIMER', 'NET_TX', 'NET_RX',
+		'BLOCK', 'IRQ_POLL', 'TASKLET', 'SCHED', 'HRTIMER', 'RCU' ]
+	zones = ['DMA', 'DMA32', 'Normal']
+	migrate_types = ['Unmovable', 'Movable', 'Reclaimable', 'HighAtomic', 'Isolate']
+	disks, ifaces, chain_rules = 8, 4, 100
+
+	def __init__( self, root, cpus=256, irqs=64, services=2000, service_procs=2,
+			cgroup_version=1, iptables_rules=50000, slabs=200,
+			sa_samples=1440, sa_format='sadf', cron_lines=1000 ):
+		self.root, self.cpus, self.irqs, self.slabs = root, cpus, irqs, slabs
+		self.service_count, self.service_procs = services, service_procs
+		self.cgroup_version = cgroup_version
+		self.iptables_rules, self.cron_lines = iptables_rules, cron_lines
+		self.sa_samples, self.sa_format = sa_samples, sa_format
+		self.nodes = max(1, cpus // 64)
+		self.services = list('bench-svc{:05d}'.format(n) for n in xrange(services))
+		self.cron_pid = self.irq_cycle = 0
+
+	def path(self, *path): return os.path.join(self.root, *path)
+
+	def write(self, path, lines, mode=None):
+		path = self.path(path)
+		if not os.path.isdir(os.path.dirname(path)): os.makedirs(os.path.dirname(path))
+		with open(path, 'wb') as dst: dst.writelines('{}\n'.format(line) for line in lines)
+		if mode is not None: os.chmod(path, mode)
+		return path
+
+	def command(self, name, output):
+		'Creates a fake binary in fixture "bin" dir, which just prints pre-generated output.'
+		return self.write( os.path.join('bin', name),
+			['#!/bin/sh', "exec cat '{}'".format(self.path(output))], mode=0755 )
+
+
+	def generate(self):
+		rng = Random(0) # all fixtures are same for same parameters
+		self.gen_proc(rng)
+		self.gen_cgroup(rng)
+		self.gen_iptables(rng)
+		self.gen_sysstat(rng)
+		self.gen_cron()
+		self.write('bench.yaml', json.dumps(self.conf(), indent=2).splitlines()) # json is valid yaml
+
+	def record(self, src='/proc'):
+		'Replaces generated /proc files with copies of ones from a real system.'
+		for name in self.proc_files:
+			try: shutil.copyfile(os.path.join(src, name), self.path('proc', name))
+			except (OSError, IOError) as err:
+				log.warn('Failed to record {} file, using generated one: {}'.format(name, err))
+
+	def conf(self):
+		'Returns configuration overrides, pointing collectors to fixtures.'
+		return dict(
+			loop=dict(backfill=dict(enabled=False)), # fixture data is mostly historical
+			collectors=dict(
+				cgacct=dict(cg_root=self.path('sys/fs/cgroup'), version=self.cgroup_version),
+				sysstat=dict( sa_path=self.path('sa'),
+					force_interval=False, schedule=dict(enabled=False) ),
+				iptables_counts=dict(rule_metrics_path=dict(
+					ipv4=self.path('iptables.metrics'), ipv6=None )),
+				cron_log=dict( source=self.path('cron.log'),
+					aliases=[['_script', r'/etc/cron\.\w+/*(?P<script>\S+)(\s+|$)']] ) ) )
+
+
+	def gen_proc(self, rng):
+		cpus, counts = xrange(self.cpus), lambda: ' '.join(
+			'{:>10}'.format(rng.randrange(10**6)) for cpu in xrange(self.cpus) )
+		header = ' ' * 4 + ''.join('{:>11}'.format('CPU{}'.format(cpu)) for cpu in cpus)
+		self.write('proc/interrupts', it.chain([header], (
+			'{:>4}: {}  IO-APIC {}-edge dev{}'.format(irq, counts(), irq, irq)
+			for irq in xrange(self.irqs) ), ['NMI: {} Non-maskable interrupts'.format(counts())] ))
+		self.write('proc/softirqs', it.chain([header], (
+			'{:>9}: {}'.format(irq, counts()) for irq in self.softirqs )))
+
+		cpu_line = lambda name: '{} {}'.format(name, ' '.join(
+			bytes(rng.randrange(10**8)) for n in xrange(10) ))
+		self.write('proc/stat', it.chain(
+			[cpu_line('cpu')], it.imap(cpu_line, ('cpu{}'.format(cpu) for cpu in cpus)),
+			[ 'intr {} {}'.format(10**9, ' '.join(it.repeat('0', self.irqs))),
+				'ctxt {}'.format(10**9), 'btime 1350000000', 'processes {}'.format(10**6),
+				'procs_running 1', 'procs_blocked 0',
+				'softirq {} {}'.format(10**9, ' '.join(it.repeat('0', len(self.softirqs)))) ] ))
+
+		self.write('proc/vmstat', ( '{} {}'.format(name, rng.randrange(10**9))
+			for name in it.chain(
+				('nr_{}'.format(k) for k in [ 'free_pages', 'inactive_anon', 'active_anon',
+					'inactive_file', 'active_file', 'unevictable', 'mlock', 'anon_pages', 'mapped',
+					'file_pages', 'dirty', 'writeback', 'slab_reclaimable', 'slab_unreclaimable',
+					'page_table_pages', 'kernel_stack', 'bounce', 'vmscan_write', 'writeback_temp',
+					'isolated_anon', 'isolated_file', 'shmem', 'dirtied', 'written', 'anon_transparent_hugepages' ]),
+				[ 'pgpgin', 'pgpgout', 'pswpin', 'pswpout', 'pgfree', 'pgactivate', 'pgdeactivate',
+					'pgfault', 'pgmajfault', 'pgrefill_normal', 'pgsteal_normal', 'pgscan_kswapd_normal',
+					'pgscan_direct_normal', 'pginodesteal', 'slabs_scanned', 'kswapd_inodesteal',
+					'pageoutrun', 'allocstall', 'pgrotated', 'compact_stall', 'compact_fail',
+					'compact_success', 'thp_fault_alloc', 'thp_collapse_alloc', 'thp_split' ] ) ))
+		self.write('proc/meminfo', it.chain(
+			( '{:<16}{:>8} kB'.format('{}:'.format(name), rng.randrange(10**7))
+				for name in [ 'MemTotal', 'MemFree', 'Buffers', 'Cached', 'SwapCached', 'Active',
+					'Inactive', 'Active(anon)', 'Inactive(anon)', 'Active(file)', 'Inactive(file)',
+					'Unevictable', 'Mlocked', 'SwapTotal', 'SwapFree', 'Dirty', 'Writeback',
+					'AnonPages', 'Mapped', 'Shmem', 'Slab', 'SReclaimable', 'SUnreclaim', 'KernelStack',
+					'PageTables', 'NFS_Unstable', 'Bounce', 'WritebackTmp', 'CommitLimit',
+					'Committed_AS', 'VmallocTotal', 'VmallocUsed', 'VmallocChunk', 'AnonHugePages',
+					'Hugepagesize', 'DirectMap4k', 'DirectMap2M' ] ),
+			( '{:<16}{:>8}'.format('{}:'.format(name), rng.randrange(100)) for name in
+				['HugePages_Total', 'HugePages_Free', 'HugePages_Rsvd', 'HugePages_Surp'] ) ))
+
+		orders = lambda: ' '.join('{:>6}'.format(rng.randrange(10**4)) for n in xrange(11))
+		self.write('proc/buddyinfo', (
+			'Node {}, zone {:>8} {}'.format(node, zone, orders())
+			for node in xrange(self.nodes) for zone in self.zones ))
+		self.write('proc/pagetypeinfo', it.chain(
+			[ 'Page block order: 9', 'Pages per block:  512', '',
+				'Free pages count per migrate type at order {}'\
+					.format(' '.join('{:>6}'.format(n) for n in xrange(11))) ],
+			( 'Node {:>4}, zone {:>8}, type {:>12} {}'.format(node, zone, mtype, orders())
+				for node in xrange(self.nodes) for zone in self.zones for mtype in self.migrate_types ),
+			[ '', 'Number of blocks type {}'.format(' '.join(self.migrate_types)) ],
+			( 'Node {}, zone {:>8} {}'.format(node, zone, orders())
+				for node in xrange(self.nodes) for zone in self.zones ) ))
+
+		slab_names = it.chain(
+			('kmalloc-{}'.format(2**n) for n in xrange(3, 14)),
+			('bench_cache_{}'.format(n) for n in it.count()) )
+		self.write('proc/slabinfo', it.chain(
+			[ 'slabinfo - version: 2.1',
+				'# name            <active_objs> <num_objs> <objsize> <objperslab> <pagesperslab>'
+					' : tunables <limit> <batchcount> <sharedfactor> : slabdata <active_slabs> <num_slabs> <sharedavail>' ],
+			( '{:<17} {:>6} {:>6} {:>6} {:>4} {:>4} : tunables 0 0 0 : slabdata {:>6} {:>6} 0'.format(
+					name, rng.randrange(10**5), 10**5, rng.choice([64, 128, 192, 512, 4096]),
+					32, rng.choice([1, 2, 8]), rng.randrange(10**4), 10**4 )
+				for name in it.islice(slab_names, self.slabs) ) ))
+
+	def gen_cgroup(self, rng):
+		pids = it.count(1000)
+		for n, svc in enumerate(self.services):
+			svc_pids = list(it.islice(pids, self.service_procs))
+			for pid in svc_pids:
+				self.write('proc/{}/comm'.format(pid), [svc])
+				self.write('proc/{}/io'.format(pid), ( '{}: {}'.format(k, rng.randrange(10**9))
+					for k in [ 'rchar', 'wchar', 'syscr', 'syscw',
+						'read_bytes', 'write_bytes', 'cancelled_write_bytes' ] ))
+			tasks = list(it.chain(svc_pids, (pid + 10**6 for pid in svc_pids))) # threads
+			if self.cgroup_version == 2:
+				self.gen_cgroup2_service(rng, n, svc, svc_pids, tasks)
+				continue
+			for rc in 'cpuacct', 'memory', 'blkio':
+				svc_dir = os.path.join('sys/fs/cgroup', rc, 'system/{}.service'.format(svc))
+				self.write(os.path.join(svc_dir, 'tasks'), tasks)
+				if rc == 'cpuacct':
+					self.write( os.path.join(svc_dir, 'cpuacct.stat'),
+						['user {}'.format(rng.randrange(10**6)), 'system {}'.format(rng.randrange(10**6))] )
+					self.write(os.path.join(svc_dir, 'cpuacct.usage'), [rng.randrange(10**12)])
+				elif rc == 'memory':
+					self.write(os.path.join(svc_dir, 'memory.stat'), (
+						'{}{} {}'.format(prefix, k, rng.randrange(10**8))
+						for prefix in ['', 'total_'] for k in [ 'cache', 'rss', 'mapped_file',
+							'pgpgin', 'pgpgout', 'swap', 'inactive_anon', 'active_anon',
+							'inactive_file', 'active_file', 'unevictable' ] ))
+				elif rc == 'blkio':
+					self.write(os.path.join(svc_dir, 'cgroup.procs'), svc_pids)
+					for metric in [ 'io_service_bytes', 'io_service_time', 'io_serviced',
+							'throttle.io_service_bytes', 'throttle.io_serviced' ]:
+						self.write(os.path.join(svc_dir, 'blkio.{}'.format(metric)), it.chain(
+							( '8:{} {} {}'.format(disk * 16, iotype, rng.randrange(10**9))
+								for disk in xrange(self.disks)
+								for iotype in ['Read', 'Write', 'Sync', 'Async', 'Total'] ),
+							['Total {}'.format(rng.randrange(10**10))] ))
+		if self.cgroup_version == 2:
+			self.write('sys/fs/cgroup/cgroup.controllers', ['cpuset cpu io memory pids'])
+		else:
+			for rc in 'cpuacct', 'memory', 'blkio': # checked to be mountpoints by collector
+				self.write(os.path.join('sys/fs/cgroup', rc, 'tasks'), [1])
+
+	def gen_cgroup2_service(self, rng, n, svc, pids, tids):
+		# Every 10th service is an instance of templated one in a nested slice
+		svc_dir = os.path.join( 'sys/fs/cgroup/system.slice', 'system-bench.slice/bench-tpl@{}.service'.format(n)
+			if n % 10 == 9 else '{}.service'.format(svc) )
+		self.write(os.path.join(svc_dir, 'cgroup.procs'), pids)
+		self.write(os.path.join(svc_dir, 'cgroup.threads'), tids)
+		self.write(os.path.join(svc_dir, 'cpu.stat'), it.chain(
+			( '{} {}'.format(k, rng.randrange(10**9))
+				for k in ['usage_usec', 'user_usec', 'system_usec'] ),
+			['nr_periods 0', 'nr_throttled 0', 'throttled_usec 0'] ))
+		self.write(os.path.join(svc_dir, 'memory.stat'), (
+			'{} {}'.format(k, rng.randrange(10**8)) for k in [ 'anon', 'file', 'kernel_stack',
+				'pagetables', 'percpu', 'sock', 'shmem', 'file_mapped', 'file_dirty', 'file_writeback',
+				'swapcached', 'anon_thp', 'inactive_anon', 'active_anon', 'inactive_file', 'active_file',
+				'unevictable', 'slab_reclaimable', 'slab_unreclaimable', 'slab', 'workingset_refault_anon',
+				'workingset_refault_file', 'workingset_activate_anon', 'workingset_activate_file',
+				'workingset_nodereclaim', 'pgfault', 'pgmajfault', 'pgrefill', 'pgscan', 'pgsteal',
+				'pgactivate', 'pgdeactivate', 'thp_fault_alloc', 'thp_collapse_alloc' ] ))
+		self.write(os.path.join(svc_dir, 'io.stat'), (
+			'8:{} rbytes={} wbytes={} rios={} wios={} dbytes=0 dios=0'.format( disk * 16,
+				rng.randrange(10**10), rng.randrange(10**10), rng.randrange(10**6), rng.randrange(10**6) )
+			for disk in xrange(self.disks) ))
+
+	def gen_iptables(self, rng):
+		chains = list('bench{}'.format(n) for n in
+			xrange(int(math.ceil(self.iptables_rules / float(self.chain_rules)))))
+		rules, metrics = list(), list()
+		for n in xrange(self.iptables_rules):
+			chain, rule = chains[n // self.chain_rules], n % self.chain_rules + 1
+			rules.append('[{}:{}] -A {} -s 10.{}.{}.{}/32 -j ACCEPT'.format(
+				rng.randrange(10**6), rng.randrange(10**9), chain, n >> 16, (n >> 8) & 0xff, n & 0xff ))
+			if rule % 10 == 1:
+				metrics.append('filter {} {} network.rules.{}_{}'.format(chain, rule, chain, rule))
+		self.write('iptables.save', it.chain(
+			['# Generated by iptables-save', '*filter'],
+			(':{} - [0:0]'.format(chain) for chain in chains), rules, ['COMMIT'],
+			[ '*nat', ':PREROUTING ACCEPT [0:0]', # table without metrics, skipped
+				'[10:600] -A PREROUTING -p tcp --dport 80 -j REDIRECT --to-ports 8080', 'COMMIT' ] ))
+		self.write('iptables.metrics', metrics)
+		self.command('iptables-save', 'iptables.save')
+		self.command('ip6tables-save', 'iptables.save')
+
+	def gen_sysstat(self, rng):
+		if self.sa_format == 'binary': return self.gen_sysstat_binary()
+		ts_now, interval, stats = int(time()), 60, list()
+		for n in xrange(self.sa_samples, 0, -1):
+			ts = gmtime(ts_now - n * interval)
+			stats.append({
+				'timestamp': dict( date=strftime('%Y-%m-%d', ts),
+					time=strftime('%H:%M:%S', ts), utc=1, interval=interval ),
+				'disk': list(dict(( ('disk-device', 'dev8-{}'.format(disk * 16)),
+						('util-percent', rng.random() * 100), ('avgrq-sz', rng.random() * 100),
+						('avgqu-sz', rng.random()), ('rd_sec', rng.random() * 10**4),
+						('wr_sec', rng.random() * 10**4), ('await', rng.random() * 10),
+						('tps', rng.random() * 100) )) for disk in xrange(self.disks)),
+				'paging': {'vmeff-percent': rng.random() * 100},
+				'kernel': { 'dentunusd': rng.randrange(10**6), 'file-nr': rng.randrange(10**4),
+					'inode-nr': rng.randrange(10**6), 'pty-nr': rng.randrange(10) },
+				'network': {
+					'net-dev': list(dict(
+						[('iface', 'eth{}'.format(iface))] + list( (k, rng.random() * 10**4)
+							for k in ['rxkB', 'rxpck', 'rxcmp', 'rxmcst', 'txkB', 'txpck'] ) )
+						for iface in xrange(self.ifaces)),
+					'net-edev': list(dict(
+						[('iface', 'eth{}'.format(iface))] + list( (k, rng.random())
+							for k in [ 'rxerr', 'rxfifo', 'rxdrop', 'rxfram',
+								'txerr', 'txfifo', 'txdrop', 'txcarr', 'coll' ] ) )
+						for iface in xrange(self.ifaces)),
+					'net-sock': dict( (k, rng.randrange(10**4))
+						for k in ['totsck', 'tcpsck', 'udpsck', 'rawsck', 'ip-frag', 'tcp-tw'] ) } })
+		self.write('sadf.json', [json.dumps(dict(sysstat=dict(hosts=[OrderedDict( # same key order as sadf
+			[('nodename', os.uname()[1]), ('statistics', stats), ('restarts', list())] )]) ))])
+		self.write('sa/sa{:02d}'.format(datetime.now().day), ['not a real sa file, see sadf.json'])
+		self.command('sadf', 'sadf.json')
+
+	def _sa_acts(self):
+		'Returns (id, has_nr, nr, types_nr, size) for activities in binary sa file fixture.'
+		from graphite_metrics.collectors import _safile as sa
+		return [ (1, 1, self.cpus + 1, (10, 0, 0), 80), # cpu, not used by collector
+			(sa.A_PAGE, 0, 1, (0, 8, 0), 64), (sa.A_KTABLES, 0, 1, (0, 0, 4), 16),
+			(sa.A_DISK, 1, self.disks, (1, 3, 12), 80), (sa.A_NET_DEV, 1, self.ifaces, (7, 0, 1), 80),
+			(sa.A_NET_EDEV, 1, self.ifaces, (9, 0, 0), 88), (sa.A_NET_SOCK, 0, 1, (0, 0, 6), 24) ]
+
+	def _sa_record(self, n, ts, rtype=1):
+		'''Returns n-th record for binary sa file fixture, with counters
+			growing linearly with n, so that all rates are same in every interval.'''
+		from graphite_metrics.collectors import _safile as sa
+		uptime, tm = n * 6000, gmtime(ts)
+		data = [sa.SAFile.record.pack(uptime, ts, 0, rtype, tm.tm_hour, tm.tm_min, tm.tm_sec)]
+		if rtype == sa.R_RESTART: return data[0] + sa.SAFile.nr.pack(self.cpus + 1)
+		if rtype == sa.R_COMMENT: return data[0] + b'bench'.ljust(sa.MAX_COMMENT_LEN, b'\0')
+		for act_id, has_nr, nr, types, size in self._sa_acts():
+			if has_nr: data.append(sa.SAFile.nr.pack(nr))
+			if act_id == sa.A_PAGE:
+				data.append(struct.pack('=8Q', *(n * k for k in [100, 200, 1000, 5, 500, 50, 10, 40])))
+			elif act_id == sa.A_KTABLES:
+				data.append(struct.pack('=4I', 2000 + n % 7, 30000, 40000 + n % 13, 5))
+			elif act_id == sa.A_DISK:
+				for disk in xrange(nr): data.append(struct.pack( '=Q3Q12I',
+					n * (10 + disk), n * 1000 * (disk + 1), n * 2000, 0,
+					n * 5, n * 7, n * 300, n * 400, 8, disk * 16, 0, 0, 0, 0, 0, 0 ))
+			elif act_id == sa.A_NET_DEV:
+				for iface in xrange(nr): data.append(struct.pack( '=7QI16sc3x',
+					n * 100, n * 80, n * 102400, n * 51200, 0, 0, n, 1000, 'eth{}'.format(iface), b'\1' ))
+			elif act_id == sa.A_NET_EDEV:
+				for iface in xrange(nr): data.append(struct.pack(
+					'=9Q16s', *(list(n * k for k in xrange(9)) + ['eth{}'.format(iface)]) ))
+			elif act_id == sa.A_NET_SOCK: data.append(struct.pack('=6I', 500, 100, 20, 30, 1, 0))
+			else: data.append(b'\0' * (size * nr))
+		return b''.join(data)
+
+	def gen_sysstat_binary(self):
+		'Writes binary sa file with sa_samples records, and a restart and a comment in the middle.'
+		from graphite_metrics.collectors import _safile as sa
+		ts_now, interval = int(time()), 60
+		ts0 = ts_now - self.sa_samples * interval
+		acts = self._sa_acts()
+		header = sa.SAFile.header.pack( ts0, 100, self.cpus + 1, len(acts), 0,
+			0, 0, 9, 2, 0, 1, sa.SAFile.activity.size, sa.SAFile.record.size, 0, 1, 1, 8,
+			'Linux', os.uname()[1] ).ljust(sa.SAFile.header.size + 65*3, b'\0')
+		path = self.path('sa/sa{:02d}'.format(datetime.now().day))
+		if not os.path.isdir(os.path.dirname(path)): os.makedirs(os.path.dirname(path))
+		with open(path, 'wb') as dst:
+			dst.write(sa.SAFile.magic.pack( sa.SAFile.sysstat_magic, sa.SAFile.format_magic,
+				12, 6, 5, 0, len(header), 0, 1, 1, 12 ).ljust(sa.SAFile.magic_size, b'\0'))
+			dst.write(header)
+			for act_id, has_nr, nr, types, size in acts:
+				dst.write(sa.SAFile.activity.pack(act_id, 0, nr, 1, has_nr, size, *types))
+			for n in xrange(self.sa_samples):
+				if n == self.sa_samples // 2:
+					dst.write(self._sa_record(0, ts0 + n * interval, sa.R_RESTART))
+					dst.write(self._sa_record(0, ts0 + n * interval, sa.R_COMMENT))
+				dst.write(self._sa_record(n, ts0 + n * interval))
+		self.write('sa.next', ['{} {}'.format(self.sa_samples, ts0 + self.sa_samples * interval)])
+
+	def gen_cron(self):
+		self.write('cron.log', list())
+
+
+	def install(self, module):
+		'''Redirects /proc paths, device name and systemd service
+			lookups in a collector module to fixtures. Used in forked bench processes.'''
+		proc, proc_open = self.path('proc'), getattr(module, 'open', open)
+		def fixture_open(path, *argz, **kwz):
+			if isinstance(path, basestring) and path.startswith('/proc/'):
+				path = os.path.join(proc, path[6:])
+			return proc_open(path, *argz, **kwz)
+		module.open = fixture_open
+		if hasattr(module, 'dev_resolve'):
+			module.dev_resolve = lambda major, minor, log_fails=True: 'sd{}'.format(chr(97 + minor // 16))
+		if hasattr(module, 'CGAcct'):
+			module.CGAcct._systemd_services = lambda self=None, _svcs=self.services: iter(_svcs)
+			cg_root, ismount = self.path('sys/fs/cgroup'), os.path.ismount
+			os.path.ismount = lambda path: path.startswith(cg_root) or ismount(path)
+		os.environ['PATH'] = '{}:{}'.format(self.path('bin'), os.environ.get('PATH', ''))
+
+	def cycle(self, name):
+		'Updates fixtures before each collector run, where necessary.'
+		if name == 'sysstat': # sa file grows, as if sadc has added new records
+			with open(self.path('sa/sa{:02d}'.format(datetime.now().day)), 'ab') as dst:
+				if self.sa_format != 'binary': dst.write('.\n')
+				else:
+					with open(self.path('sa.next'), 'rb') as src: n, ts = map(int, src.read().split())
+					dst.write(self._sa_record(n, ts))
+					self.write('sa.next', ['{} {}'.format(n + 1, ts + 60)])
+		if name in ['irq', 'loop']: # counters in every 10th row of irq tables are bumped
+			self.irq_cycle += 1
+			for table in 'interrupts', 'softirqs':
+				with open(self.path('proc', table), 'rb') as src: lines = src.read().splitlines()
+				for n in xrange(1 + self.irq_cycle % 10, len(lines), 10):
+					irq, fields = lines[n].split(':', 1)
+					fields = fields.split()
+					fields[:self.cpus] = (bytes(int(v) + 1) for v in fields[:self.cpus])
+					lines[n] = '{}: {}'.format(irq, ' '.join(fields))
+				self.write(os.path.join('proc', table), lines)
+		if name not in ['cron_log', 'loop']: return
+		ts = strftime('%Y-%m-%dT%H:%M:%SZ', gmtime())
+		with open(self.path('cron.log'), 'ab') as dst:
+			for n in xrange(0, self.cron_lines, 2):
+				self.cron_pid += 1
+				dst.write(( '{ts} task[{pid}]: Started: /etc/cron.hourly/job{job}\n'
+					'{ts} task[{pid}]: Finished (duration=12, status=0): /etc/cron.hourly/job{job}\n' )\
+					.format(ts=ts, pid=self.cron_pid, job=n % 50))
+
+
+class CarbonListener(threading.Thread):
+
+	'Stand-in carbon daemon, accepting connections and discarding all received data.'
+
+	daemon = True
+
+	def __init__(self):
+		super(CarbonListener, self).__init__()
+		self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		self.sock.bind(('127.0.0.1', 0))
+		self.sock.listen(16)
+		self.host, self.received = self.sock.getsockname(), 0
+
+	def run(self):
+		while True:
+			conn, addr = self.sock.accept()
+			while True:
+				data = conn.recv(2**20)
+				if not data: break
+				self.received += len(data)
+			conn.close()
+
+
+def percentile(values, p):
+	'Nearest-rank percentile of sorted values.'
+	return values[max(0, min(len(values), int(math.ceil(p / 100.0 * len(values)))) - 1)]
+
+def rss():
+	with open('/proc/self/statm', 'rb') as src: return int(src.read().split()[1]) * page_size
+
+def measure(cycle, cycles, setup=None):
+	'''Runs cycle() (returning number of datapoints) once to warm up
+			(e.g. to seed counters), then specified number of times.
+		Returns dict with throughput, cycle latency percentiles and peak memory usage.'''
+	rss_start = rss()
+	if setup: setup()
+	cycle()
+	times, count = list(), 0
+	for n in xrange(cycles):
+		if setup: setup()
+		ts = time()
+		count += cycle()
+		times.append(time() - ts)
+	rss_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+	times.sort()
+	return OrderedDict([
+		('cycles', cycles), ('datapoints', count // cycles),
+		('throughput', count / (sum(times) or 1e-9)),
+		('latency', OrderedDict( (k, percentile(times, p))
+			for k, p in [('p50', 50), ('p90', 90), ('p99', 99), ('max', 100)] )),
+		('rss_peak', rss_peak), ('rss_growth', max(0, rss_peak - rss_start)) ])
+
+def forked(func, *argz):
+	'Runs func in a forked child process, so that peak memory and any patching are its own.'
+	import cPickle as pickle
+	r, w = os.pipe()
+	pid = os.fork()
+	if not pid:
+		os.close(r)
+		try: res = True, func(*argz)
+		except Exception as err:
+			log.exception('Benchmark failed: {}'.format(err))
+			res = False, '{}: {}'.format(err.__class__.__name__, err)
+		with os.fdopen(w, 'wb') as dst: pickle.dump(res, dst, 2)
+		os._exit(0)
+	os.close(w)
+	with os.fdopen(r, 'rb') as src: res = src.read()
+	os.waitpid(pid, 0)
+	ok, res = pickle.loads(res) if res else (False, 'benchmark process died')
+	if not ok: raise BenchError(res)
+	return res
+
+
+def load_collector(cfg, fixtures, name):
+	module = importlib.import_module('graphite_metrics.collectors.{}'.format(name))
+	fixtures.install(module)
+	collector = module.collector(cfg.collectors[name])
+	if not cfg.collectors[name].get('enabled', True):
+		raise BenchError('collector disabled itself on init')
+	return collector
+
+def bench_collector(cfg, fixtures, name, cycles):
+	collector = load_collector(cfg, fixtures, name)
+	return measure( lambda: len(collector.read_batch()),
+		cycles, setup=ft.partial(fixtures.cycle, name) )
+
+def bench_loop(cfg, fixtures, names, cycles, protocol='line'):
+	from graphite_metrics.loops.basic import BasicLoop
+	from graphite_metrics.processors.hostname_prefix import HostnamePrefix
+	from graphite_metrics.sinks.carbon_socket import CarbonSocket
+
+	listener = CarbonListener()
+	listener.start()
+	collectors = OrderedDict()
+	for name in names:
+		try: collectors[name] = load_collector(cfg, fixtures, name)
+		except Exception as err:
+			log.info('Skipping collector {} in loop benchmark: {}'.format(name, err))
+	if not collectors: raise BenchError('no collectors could be loaded')
+	conf = cfg.sinks.carbon_socket
+	conf.update(host=listener.host, protocol=protocol, destinations=None)
+	sinks = dict(carbon_socket=CarbonSocket(conf))
+	loop = BasicLoop(cfg.loop)
+	chain = loop.chain(OrderedDict(hostname_prefix=HostnamePrefix(cfg.processors.hostname_prefix)))
+
+	def cycle():
+		data = loop.poll(collectors)
+		sink_data = loop.process(data, chain, sinks, loop.time_func())
+		loop.dispatch(sink_data, sinks)
+		return sum(it.imap(len, sink_data.viewvalues()))
+	res = measure(cycle, cycles, setup=ft.partial(fixtures.cycle, 'loop'))
+	res['collectors'] = list(collectors)
+	return res
+
+
+def format_result(name, res):
+	mb = lambda v: '{:.1f}M'.format(v / 2.0**20)
+	return ( '{name:<16} {cycles:>3} cycles {datapoints:>9} dps/cycle {throughput:>11,.0f} dps/s'
+		'  latency p50/p90/p99/max: {lat[p50]:.4f}/{lat[p90]:.4f}/{lat[p99]:.4f}/{lat[max]:.4f}s'
+		'  rss: {rss} (+{rss_growth})' ).format( name=name, lat=res['latency'],
+			rss=mb(res['rss_peak']), rss_growth=mb(res['rss_growth']),
+			cycles=res['cycles'], datapoints=res['datapoints'], throughput=res['throughput'] )
+
+def compare(results, baseline, threshold):
+	'Returns list of (target, metric, old, new) for values that got worse by more than threshold %.'
+	regressions = list()
+	for name, res in results.viewitems():
+		base = baseline.get(name)
+		if not base or 'error' in res or 'error' in base: continue
+		for metric, old, new in [
+				('latency.p50', base['latency']['p50'], res['latency']['p50']),
+				('latency.p99', base['latency']['p99'], res['latency']['p99']),
+				('rss_peak', base['rss_peak'], res['rss_peak']) ]:
+			if new > old * (1 + threshold / 100.0): regressions.append((name, metric, old, new))
+	return regressions
+
+
+def main(args=None):
+	import argparse
+	parser = argparse.ArgumentParser(
+		description='Benchmark collectors and loop -> processor -> sink path'
+			' against generated (or recorded) /proc, cgroup and command output fixtures.')
+	parser.add_argument('targets', nargs='*', metavar='target',
+		help='Collectors (and/or "loop") to benchmark, default: {}.'.format(', '.join(targets)))
+	parser.add_argument('-n', '--cycles', type=int, default=10, metavar='n',
+		help='Number of measured cycles per target (default: %(default)s).')
+
+	parser.add_argument('-r', '--root', metavar='path',
+		help='Directory to generate fixtures in (default: temporary directory).'
+			' Existing fixtures there (e.g. from previous --keep run) are re-used as-is.')
+	parser.add_argument('--record', action='store_true',
+		help='Copy {} files from this system to /proc fixtures,'
+			' instead of generated ones.'.format(', '.join(Fixtures.proc_files)))
+	parser.add_argument('--keep', action='store_true',
+		help='Do not remove generated fixtures directory.')
+
+	parser.add_argument('--cpus', type=int, default=256, metavar='n',
+		help='Number of cpus in irq/stat fixtures (default: %(default)s).')
+	parser.add_argument('--irqs', type=int, default=64, metavar='n',
+		help='Number of hardware irqs in /proc/interrupts (default: %(default)s).')
+	parser.add_argument('--slabs', type=int, default=200, metavar='n',
+		help='Number of /proc/slabinfo entries (default: %(default)s).')
+	parser.add_argument('--services', type=int, default=2000, metavar='n',
+		help='Number of systemd services with cgroups (default: %(default)s).')
+	parser.add_argument('--service-procs', type=int, default=2, metavar='n',
+		help='Number of processes in each service cgroup (default: %(default)s).')
+	parser.add_argument('--cgroup-version', type=int, choices=[1, 2], default=1,
+		help='cgroup hierarchy version to generate (default: %(default)s).')
+	parser.add_argument('--iptables-rules', type=int, default=50000, metavar='n',
+		help='Number of rules in iptables-save output, every 10th'
+			' of these has a metric attached (default: %(default)s).')
+	parser.add_argument('--sa-samples', type=int, default=1440, metavar='n',
+		help='Number of samples in sadf -j output or sa file (default: %(default)s).')
+	parser.add_argument('--sa-format', choices=['sadf', 'binary'], default='sadf',
+		help='Generate canned sadf -j output (with non-parseable sa file),'
+			' or binary sa file to read in-process (default: %(default)s).')
+	parser.add_argument('--cron-lines', type=int, default=1000, metavar='n',
+		help='Number of cron log lines appended before each cycle (default: %(default)s).')
+	parser.add_argument('--protocol', choices=['line', 'pickle'], default='line',
+		help='Carbon protocol to use in loop benchmark (default: %(default)s).')
+
+	parser.add_argument('--json', action='store_true',
+		help='Print results as json instead of human-readable lines.')
+	parser.add_argument('--save', metavar='path',
+		help='Save results to specified json file, to be used with --baseline later.')
+	parser.add_argument('--baseline', metavar='path',
+		help='Compare results to ones saved in specified json file,'
+			' exiting with non-zero status if any of these got worse than --threshold.')
+	parser.add_argument('--threshold', type=float, default=20, metavar='percent',
+		help='Max acceptable increase of latency or peak memory'
+			' from --baseline values, in percent (default: %(default)s).')
+	parser.add_argument('--debug', action='store_true', help='Verbose operation mode.')
+	optz = parser.parse_args(args)
+
+	from lya import AttrDict, configure_logging
+	from graphite_metrics import collectors as collectors_pkg
+	import tempfile
+
+	cfg = AttrDict.from_yaml(os.path.join(os.path.dirname(__file__), 'harvestd.yaml'))
+	configure_logging(cfg.logging, logging.DEBUG if optz.debug else logging.WARNING)
+
+	bench_targets = optz.targets or targets
+	for name in bench_targets:
+		if name not in targets: parser.error('Unknown benchmark target: {}'.format(name))
+
+	root, cleanup = optz.root, False
+	if not root: root, cleanup = tempfile.mkdtemp(prefix='harvestd-bench.'), not optz.keep
+	try:
+		fixtures = Fixtures( os.path.abspath(root), cpus=optz.cpus, irqs=optz.irqs,
+			services=optz.services, service_procs=optz.service_procs,
+			cgroup_version=optz.cgroup_version,
+			iptables_rules=optz.iptables_rules, slabs=optz.slabs,
+			sa_samples=optz.sa_samples, sa_format=optz.sa_format, cron_lines=optz.cron_lines )
+		if not os.path.exists(fixtures.path('bench.yaml')):
+			log.debug('Generating fixtures in: {}'.format(fixtures.root))
+			forked(fixtures.generate) # to not inflate rss of benchmark processes
+		if optz.record: fixtures.record()
+
+		# Same layering of configuration as in harvestd
+		cfg.update_yaml(fixtures.path('bench.yaml'))
+		for ep in 'collectors', 'processors', 'sinks':
+			conf_base = cfg[ep].pop('_default')
+			if 'debug' not in conf_base: conf_base['debug'] = cfg.debug
+			for name in cfg[ep].keys():
+				if cfg[ep][name] is None: cfg[ep][name] = AttrDict()
+				cfg[ep][name].rebase(conf_base)
+		cfg.loop.debug = cfg.debug
+		collectors_pkg.cfg = cfg
+
+		results = OrderedDict()
+		for name in bench_targets:
+			try:
+				results[name] = forked( bench_loop, cfg, fixtures,
+						list(n for n in bench_targets if n != 'loop') or collectors,
+						optz.cycles, optz.protocol )\
+					if name == 'loop' else forked(bench_collector, cfg, fixtures, name, optz.cycles)
+			except BenchError as err: results[name] = dict(error=bytes(err))
+			if not optz.json:
+				print( format_result(name, results[name]) if 'error' not in results[name]
+					else '{:<16} failed: {}'.format(name, results[name]['error']) )
+				sys.stdout.flush()
+	finally:
+		if cleanup: shutil.rmtree(root, ignore_errors=True)
+
+	if optz.json: print(json.dumps(results, indent=2))
+	if optz.save:
+		with open(optz.save, 'wb') as dst: json.dump(results, dst, indent=2)
+	if optz.baseline:
+		with open(optz.baseline, 'rb') as src: baseline = json.load(src)
+		regressions = compare(results, baseline, optz.threshold)
+		for name, metric, old, new in regressions:
+			print( 'Regression: {} {} {:.4g} -> {:.4g} (+{:.0f}%)'\
+				.format(name, metric, old, new, (new / float(old or 1e-9) - 1) * 100) )
+		if regressions: return 1
+
+if __name__ == '__main__': sys.exit(main())
@@ -2,9 +2,10 @@
 
 import itertools as it, operator as op, functools as ft
 from collections import namedtuple
+from array import array
 from glob import iglob
 from time import time
-import os
+import os, struct, atexit
 
 import logging
 log = logging.getLogger(__name__)
@@ -38,6 +39,38 @@ def rate_limit(max_interval=20, sampling=3, f=lambda x: x):
 		val += 1
 
 
+class RunSchedule(object):
+
+	'''Deterministic schedule for expensive collectors - alternative to rate_limit.
+		Runs are due every "interval" seconds, randomly offset by up to
+			+/- "jitter" fraction of it (picked after each run), so that runs of
+			collectors on different hosts don't happen in lockstep.
+		Interval gets shortened linearly down to interval_min as "backlog" value,
+			passed to due() (e.g. amount of unprocessed data), approaches backlog_max.'''
+
+	def __init__( self, interval, interval_min=None,
+			jitter=0.1, backlog_max=None, time_func=time ):
+		from random import Random
+		self.interval, self.interval_min = interval, min(interval, interval_min or interval)
+		self.jitter, self.backlog_max, self.time_func = jitter or 0, backlog_max, time_func
+		self.random, self.ts_last, self.offset = Random(), None, 0
+
+	def next_interval(self, backlog=None):
+		interval = self.interval
+		if backlog and self.backlog_max:
+			k = min(1.0, float(backlog) / self.backlog_max)
+			interval -= (interval - self.interval_min) * k
+		return interval * (1 + self.offset)
+
+	def due(self, backlog=None):
+		'Returns True and marks schedule as ran, if the next run is due at the moment.'
+		ts = self.time_func()
+		if self.ts_last is not None\
+				and ts < self.ts_last + self.next_interval(backlog): return False
+		self.ts_last, self.offset = ts, self.random.uniform(-self.jitter, self.jitter)
+		return True
+
+
 def dev_resolve( major, minor,
 		log_fails=True, _cache = dict(), _cache_time=600 ):
 	ts_now, dev_cached = time(), False
@@ -74,44 +107,310 @@ class Collector(object):
 			' overidden in collector subclasses to return list of Datapoint objects.' )
 		# return [Datapoint(...), Datapoint(...), ...]
 
+	def read_batch(self):
+		'''Returns DatapointBatch of collected values.
+			Built from read() by default, but can be overidden to avoid
+				creating Datapoint objects, in which case read() can just iterate over it.'''
+		return DatapointBatch(self.read())
+
+
+class CounterRates(object):
+
+	'''Counter-to-rate conversion engine.
+		Metric names are mapped to stable integer ids, which index preallocated arrays
+			of last values and timestamps, so that rates for the whole batch of counters
+			are calculated by a few bulk operations, without per-name dict of tuples.
+		Negative deltas are treated as counter resets, unless counter width
+			was declared by collector (see set_bits method) - then these are wraparounds.
+			For undeclared widths, wraparound of 32-bit or 64-bit counter is only assumed if
+				previous value was in the upper part (see wrap_margin) of the range and resulting
+				rate is within wrap_rate_factor of the previous one (so not e.g. 64-bit reset).
+		Counters that weren't updated for "timeout" seconds are dropped incrementally,
+			checking up to cleanup_step slots (one per passed value) on each call.
+		State can be persisted to a file (see "persist" method) to calculate rates
+			on the first cycle after restart, instead of re-initializing all counters.
+			It is tagged with kernel boot_id and discarded after reboot.'''
+
+	wrap_margin = 0.5 # fraction of counter range, above which wraparound is possible
+	wrap_limits = 2**32, 2**64
+	wrap_rate_factor = 4 # max ratio of rate after undeclared wraparound to the last one
+	grow_min = 1024 # slots
+	cleanup_step = 1024 # slots
+
+	def __init__(self, timeout=12 * 3600):
+		self.timeout, self.ids, self.names, self.free = timeout, dict(), list(), list()
+		self.values, self.ts = array('d'), array('d') # ts=0 for unused slots
+		self.rates_last, self.bits = array('d'), dict() # bits: name -> declared width
+		self.cleanup_pos = 0
+		self.state_path = self.state_interval = self.state_ts = None
+
+	def grow(self):
+		size = len(self.names)
+		step = max(self.grow_min, size)
+		self.names.extend(it.repeat(None, step))
+		self.values.extend(array('d', [0]) * step)
+		self.ts.extend(array('d', [0]) * step)
+		self.rates_last.extend(array('d', [0]) * step)
+		self.free.extend(xrange(size + step - 1, size - 1, -1))
+
+	def register(self, name):
+		log.debug('Initializing bucket for new counter: {}'.format(name))
+		if not self.free: self.grow()
+		n = self.ids[name] = self.free.pop()
+		self.names[n] = name
+		return n
+
+	def cleanup(self, ts_now, count):
+		size = len(self.names)
+		n0 = self.cleanup_pos
+		n1 = min(size, n0 + min(self.cleanup_step, max(1, count)))
+		ts_stale, names, tss, dropped = ts_now - self.timeout, self.names, self.ts, 0
+		for n in xrange(n0, n1):
+			if names[n] is None or tss[n] > ts_stale: continue
+			del self.ids[names[n]]
+			names[n], self.values[n], tss[n], self.rates_last[n] = None, 0, 0, 0
+			self.free.append(n)
+			dropped += 1
+		if dropped: log.debug('Counter cache cleanup: {} buckets'.format(dropped))
+		self.cleanup_pos = n1 if n1 < size else 0
+
+	def set_bits(self, names, bits):
+		'Declares width of specified counters, so that negative deltas for these are wraparounds.'
+		self.bits.update(it.izip(names, it.repeat(bits)))
+
+	def wrap(self, name, v0, v, dt, rate_last):
+		'Returns delta for counter wraparound from v0 to v, or None if it looks like reset.'
+		bits = self.bits.get(name)
+		if bits:
+			limit = 2**bits
+			return (limit - v0 + v) if v0 < limit and v < limit else None
+		for limit in self.wrap_limits:
+			if v0 < limit:
+				if v0 < limit * self.wrap_margin or v >= limit: break
+				d = limit - v0 + v
+				if dt <= 0 or d / dt > rate_last * self.wrap_rate_factor: break
+				return d
+		return None
+
+	def rates(self, names, values, ts, ts_now=None):
+		'''Returns list of per-second rates for sequences of counter names,
+				values and timestamps, with None where rate can't be calculated
+				(new counter, reset, double-poll), storing values for the next call.'''
+		ids, bad = map(self.ids.get, names), set()
+		if None in ids:
+			for n, i in enumerate(ids):
+				if i is not None: continue
+				i = ids[n] = self.ids.get(names[n]) # same name can be repeated
+				if i is None: ids[n] = self.register(names[n])
+				bad.add(n)
+		v0, t0 = map(self.values.__getitem__, ids), map(self.ts.__getitem__, ids)
+		map(self.values.__setitem__, ids, values)
+		map(self.ts.__setitem__, ids, ts)
+		dv, dt = map(op.sub, values, v0), map(op.sub, ts, t0)
+
+		if 0 in dt:
+			for n, d in enumerate(dt):
+				if d or n in bad: continue
+				log.warn('Double-poll of a counter for {!r}'.format(names[n]))
+				bad.add(n)
+		if dv and min(dv) < 0:
+			for n, d in enumerate(dv):
+				if d >= 0 or n in bad: continue
+				d = self.wrap(names[n], v0[n], values[n], dt[n], self.rates_last[ids[n]])
+				if d is None:
+					log.debug( 'Detected counter reset'
+						' (negative delta): {}, {} -> {}'.format(names[n], v0[n], values[n]) )
+					bad.add(n)
+				else: dv[n] = d
+		for n in bad: dt[n] = 1
+		rates = map(op.truediv, dv, dt)
+		map(self.rates_last.__setitem__, ids, rates)
+		for n in bad: self.rates_last[ids[n]], rates[n] = 0, None
+
+		ts_now = ts_now or time()
+		self.cleanup(ts_now, len(names))
+		if self.state_ts and ts_now >= self.state_ts: self.dump()
+		return rates
+
+
+	state_header = struct.Struct('=4s16sI') # magic, boot_id, counter count
+	state_magic = 'gmc2'
+
+	@staticmethod
+	def boot_id():
+		'Returns 16-byte id of the current boot, or null bytes if it is unavailable.'
+		try:
+			with open('/proc/sys/kernel/random/boot_id', 'rb') as src:
+				return src.read().strip().replace('-', '').decode('hex')
+		except (OSError, IOError, TypeError): return '\0' * 16
+
+	def dump(self, path=None):
+		'''Atomically writes state of all counters to a file, in a compact, host-specific
+			format - header (with boot_id), two arrays (values, timestamps), names.'''
+		path = path or self.state_path
+		live = list(it.imap(op.is_not, self.names, it.repeat(None)))
+		names = list(it.compress(self.names, live))
+		log.debug('Saving state of {} counters to: {}'.format(len(names), path))
+		with open('{}.tmp'.format(path), 'wb') as dst:
+			dst.write(self.state_header.pack(self.state_magic, self.boot_id(), len(names)))
+			array('d', it.compress(self.values, live)).tofile(dst)
+			array('d', it.compress(self.ts, live)).tofile(dst)
+			dst.write('\0'.join(names))
+		os.rename('{}.tmp'.format(path), path)
+		if self.state_interval: self.state_ts = time() + self.state_interval
+
+	def load(self, path, max_age=None):
+		'''Restores counters from a file, written by dump(), skipping ones older than max_age.
+			Whole state is discarded if it was saved before reboot, as all counters are reset then.'''
+		with open(path, 'rb') as src:
+			magic, boot_id, count = self.state_header.unpack(src.read(self.state_header.size))
+			if magic != self.state_magic:
+				raise ValueError('Unrecognized counter state file format: {}'.format(path))
+			if boot_id != self.boot_id():
+				log.info('Discarding counter state, saved before reboot: {}'.format(path))
+				return
+			values, ts = array('d'), array('d')
+			values.fromfile(src, count)
+			ts.fromfile(src, count)
+			names = src.read().split('\0') if count else list()
+		if len(names) != count:
+			raise ValueError('Counter state file seem to be truncated: {}'.format(path))
+		ts_min, loaded = (time() - max_age) if max_age else 0, 0
+		for name, value, ts in it.izip(names, values, ts):
+			if ts < ts_min: continue
+			n = self.ids.get(name)
+			if n is None: n = self.register(intern(name))
+			self.values[n], self.ts[n] = value, ts
+			loaded += 1
+		log.debug('Restored {} (of {}) counters from: {}'.format(loaded, count, path))
+
+	def persist(self, path, interval=None, max_age=None):
+		'''Loads counters from path, if it exists, and keeps saving them
+			there every "interval" seconds (if specified) and on exit.'''
+		if os.path.exists(path):
+			try: self.load(path, max_age=max_age)
+			except (OSError, IOError, ValueError, EOFError, struct.error) as err:
+				log.warn('Failed to restore counter state from {}: {}'.format(path, err))
+		self.state_path, self.state_interval = path, interval
+		if interval: self.state_ts = time() + interval
+		atexit.register(self.dump)
+
+counter_rates = CounterRates()
+
 
 class Datapoint(namedtuple('Value', 'name type value ts')):
-	_counter_cache = dict()
-	_counter_cache_check_ts = 0
-	_counter_cache_check_timeout = 12 * 3600
-	_counter_cache_check_count = 4
 
-	def _counter_cache_cleanup(self, ts, to):
-		cleanup_list = list( k for k,(v,ts_chk) in
-			self._counter_cache.viewitems() if (ts - to) > ts_chk )
-		log.debug('Counter cache cleanup: {} buckets'.format(len(cleanup_list)))
-		for k in cleanup_list: del self._counter_cache[k]
+	@staticmethod
+	def rate(name, value, ts):
+		'Returns rate for a counter value, or None if it cannot be calculated yet.'
+		return counter_rates.rates([name], [value], [ts])[0]
 
 	def get(self, ts=None, prefix=None):
 		ts = self.ts or ts or time()
-		if ts > Datapoint._counter_cache_check_ts:
-			self._counter_cache_cleanup( ts,
-				self._counter_cache_check_timeout )
-			Datapoint._counter_cache_check_ts = ts\
-				+ self._counter_cache_check_timeout\
-				/ self._counter_cache_check_count
 		if self.type == 'counter':
-			if self.name not in self._counter_cache:
-				log.debug('Initializing bucket for new counter: {}'.format(self.name))
-				self._counter_cache[self.name] = self.value, ts
-				return None
-			v0, ts0 = self._counter_cache[self.name]
-			if ts == ts0:
-				log.warn('Double-poll of a counter for {!r}'.format(self.name))
-				return None
-			value = float(self.value - v0) / (ts - ts0)
-			self._counter_cache[self.name] = self.value, ts
-			if value < 0:
-				# TODO: handle overflows properly, w/ limits
-				log.debug( 'Detected counter overflow'
-					' (negative delta): {}, {} -> {}'.format(self.name, v0, self.value) )
-				return None
+			value = self.rate(self.name, self.value, ts)
+			if value is None: return None
 		elif self.type == 'gauge': value = self.value
 		else: raise TypeError('Unknown type: {}'.format(self.type))
 		name = self.name if not prefix else '{}.{}'.format(prefix, self.name)
 		return name, value, int(ts)
+
+
+class DatapointBatch(object):
+
+	'''Compact columnar storage for any number of datapoints:
+			metric names (interned) in a list, types, values and timestamps
+			in typed arrays, with zero timestamp standing for None.
+		Can be built from (or extended with) Datapoint tuples,
+			and yields these on iteration, so can be used in place of a list of them.'''
+
+	__slots__ = 'names', 'types', 'values', 'ts'
+	type_names = 'gauge', 'counter' # index is stored in "types" array
+	type_ids = dict((k, n) for n, k in enumerate(type_names))
+
+	def __init__(self, datapoints=None):
+		self.names, self.types = list(), array('B')
+		self.values, self.ts = array('d'), array('d')
+		if datapoints is not None: self.extend(datapoints)
+
+	def __len__(self): return len(self.names)
+
+	def __iter__(self):
+		for name, t, value, ts in it.izip(self.names, self.types, self.values, self.ts):
+			yield Datapoint(name, self.type_names[t], value, ts or None)
+
+	def __repr__(self): return '<DatapointBatch [{}]>'.format(len(self))
+
+	def append(self, name, type, value, ts=None):
+		try: type = self.type_ids[type]
+		except KeyError: raise TypeError('Unknown type: {}'.format(type))
+		self.names.append(intern(name) if isinstance(name, str) else name)
+		self.types.append(type)
+		self.values.append(value)
+		self.ts.append(ts or 0)
+
+	def extend(self, datapoints):
+		if isinstance(datapoints, DatapointBatch):
+			self.names.extend(datapoints.names)
+			self.types.extend(datapoints.types)
+			self.values.extend(datapoints.values)
+			self.ts.extend(datapoints.ts)
+		else:
+			for dp in datapoints: self.append(*dp)
+
+	def extend_values(self, names, type, values, ts=None):
+		'Adds datapoints of the same type and timestamp from sequences of names and values.'
+		count = len(self.names)
+		self.names.extend(names)
+		count = len(self.names) - count
+		self.types.extend(array('B', [self.type_ids[type]]) * count)
+		self.values.extend(values)
+		self.ts.extend(array('d', [ts or 0]) * count)
+
+	def get(self, ts=None):
+		'''Returns new batch of gauges, with counters converted to rates
+			(or dropped, if these can't be calculated) and all timestamps set.'''
+		res, ts, types = DatapointBatch(), ts or time(), self.types
+		tss = self.ts if 0 not in self.ts else array('d', (t or ts for t in self.ts))
+		gauges = map(op.not_, types)
+		res.names.extend(it.compress(self.names, gauges))
+		res.values.extend(it.compress(self.values, gauges))
+		res.ts.extend(it.compress(tss, gauges))
+		if any(types):
+			names, values, tss = (list(it.compress(col, types)) for col in [self.names, self.values, tss])
+			rates = counter_rates.rates(names, values, tss, ts)
+			valid = list(it.imap(op.is_not, rates, it.repeat(None)))
+			res.names.extend(it.compress(names, valid))
+			res.values.extend(it.compress(rates, valid))
+			res.ts.extend(it.compress(tss, valid))
+		res.types.extend(array('B', [0]) * len(res.names))
+		return res
+
+	def select(self, mask):
+		'Returns new batch with only datapoints that have true value in the mask sequence.'
+		res = DatapointBatch()
+		res.names.extend(it.compress(self.names, mask))
+		res.types.extend(it.compress(self.types, mask))
+		res.values.extend(it.compress(self.values, mask))
+		res.ts.extend(it.compress(self.ts, mask))
+		return res
+
+	def take(self, indexes):
+		'Returns new batch with datapoints at specified indexes, in the same order as these.'
+		indexes, res = list(indexes), DatapointBatch()
+		res.names.extend(it.imap(self.names.__getitem__, indexes))
+		res.types.extend(it.imap(self.types.__getitem__, indexes))
+		res.values.extend(it.imap(self.values.__getitem__, indexes))
+		res.ts.extend(it.imap(self.ts.__getitem__, indexes))
+		return res
+
+	def slice(self, n0, n1=None):
+		'Returns new batch with a contiguous range of datapoints.'
+		res = DatapointBatch()
+		res.names, res.types = self.names[n0:n1], self.types[n0:n1]
+		res.values, res.ts = self.values[n0:n1], self.ts[n0:n1]
+		return res
+
+	def tuples(self):
+		'Returns iterator over (name, value, timestamp) tuples, as passed to processors/sinks.'
+		return it.izip(self.names, self.values, it.imap(int, self.ts))
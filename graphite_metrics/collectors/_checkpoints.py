@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+import itertools as it, operator as op, functools as ft
+from hashlib import sha1
+from time import time
+import os, errno, struct, atexit
+
+try: from simplejson import loads, dumps
+except ImportError: from json import loads, dumps
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class Checkpoints(object):
+
+	'''Positions in followed log files, along with length and checksum of the line
+			right before each position (so that line itself doesn't have to be stored),
+			to detect truncation or replacement of the file when restoring these.
+		Updates are only kept in memory until flush(), which writes out ones
+			that have changed - either atomically into a single state file (if path is set),
+			or into xattrs (if xattr_name is set) of the followed files themselves.
+		State file also stores inode/device of each file, so that position
+			isn't applied to a different (e.g. rotated) file under the same path.'''
+
+	xattr_pos = struct.Struct('=II') # pos, line length, followed by sha1 digest
+
+	def __init__(self, path=None, xattr_name=None, dry_run=False):
+		self.path, self.xattr_name, self.dry_run = path, xattr_name, dry_run
+		self.state, self.pending, self.flush_ts = dict(), dict(), 0
+		if self.path:
+			try:
+				with open(self.path, 'rb') as src: self.state = loads(src.read())
+			except (OSError, IOError) as err:
+				if err.errno != errno.ENOENT:
+					log.warn('Failed to read checkpoint state file ({}): {}'.format(self.path, err))
+			except ValueError as err:
+				log.warn('Discarding malformed checkpoint state file ({}): {}'.format(self.path, err))
+		atexit.register(self.flush)
+
+	def _xattr(self, src):
+		from xattr import xattr
+		return xattr(src)
+
+	def get(self, key, src):
+		'Returns (pos, line_len, sha1_digest) recorded for file object or None.'
+		if self.path:
+			pos = self.state.get(key)
+			if not pos: return None
+			pos, ino, dev, line_len, chksum = pos
+			src_stat = os.fstat(src.fileno())
+			if (src_stat.st_ino, src_stat.st_dev) != (ino, dev):
+				log.info('File was replaced since last recorded position, ignoring it: {}'.format(key))
+				return None
+			return pos, line_len, chksum.decode('hex')
+		elif self.xattr_name:
+			try: pos = self._xattr(src)[self.xattr_name]
+			except (KeyError, IOError): return None
+			return self.xattr_pos.unpack(pos[:self.xattr_pos.size]) + (pos[self.xattr_pos.size:],)
+
+	def restore(self, key, src):
+		'Seeks file object to the recorded position, if it checks out, or to the start otherwise.'
+		pos = self.get(key, src)
+		if not pos: return src.seek(0)
+		pos, line_len, chksum = pos
+		try:
+			if os.fstat(src.fileno()).st_size < pos:
+				raise IOError('File was truncated since last recorded position')
+			src.seek(pos - line_len)
+			if sha1(src.read(line_len)).digest() != chksum:
+				raise IOError('Last log line doesnt match checksum')
+		except (OSError, IOError) as err:
+			log.info('Failed to restore log position ({}): {}'.format(key, err))
+			src.seek(0)
+
+	def update(self, key, src, pos, line):
+		'Records position in a file object after the line, to be written out on flush().'
+		self.pending[key] = src, pos, line
+
+	def flush(self, min_interval=None):
+		'Writes out all positions, updated since last flush, if min_interval has passed since then.'
+		ts = time()
+		if not self.pending or (min_interval and ts < self.flush_ts + min_interval): return
+		pending, self.pending, self.flush_ts = self.pending, dict(), ts
+		if self.dry_run: return
+		if self.path:
+			for key, (src, pos, line) in pending.viewitems():
+				if src.closed: continue # rotated, no lines from new file yet
+				src_stat = os.fstat(src.fileno())
+				self.state[key] = pos, src_stat.st_ino,\
+					src_stat.st_dev, len(line), sha1(line).hexdigest()
+			log.debug('Saving {} log position(s) to: {}'.format(len(pending), self.path))
+			with open('{}.tmp'.format(self.path), 'wb') as dst:
+				dst.write(dumps(self.state))
+				dst.flush()
+				os.fsync(dst.fileno())
+			os.rename('{}.tmp'.format(self.path), self.path)
+		elif self.xattr_name:
+			for key, (src, pos, line) in pending.viewitems():
+				if src.closed: continue
+				self._xattr(src)[self.xattr_name] =\
+					self.xattr_pos.pack(pos, len(line)) + sha1(line).digest()
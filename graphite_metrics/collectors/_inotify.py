@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+import itertools as it, operator as op, functools as ft
+from ctypes.util import find_library
+import os, errno, struct, ctypes
+
+import logging
+log = logging.getLogger(__name__)
+
+
+# See inotify(7) for descriptions
+IN_ACCESS, IN_MODIFY, IN_ATTRIB = 0x1, 0x2, 0x4
+IN_CLOSE_WRITE, IN_CLOSE_NOWRITE, IN_OPEN = 0x8, 0x10, 0x20
+IN_MOVED_FROM, IN_MOVED_TO, IN_CREATE, IN_DELETE = 0x40, 0x80, 0x100, 0x200
+IN_DELETE_SELF, IN_MOVE_SELF = 0x400, 0x800
+IN_UNMOUNT, IN_Q_OVERFLOW, IN_IGNORED = 0x2000, 0x4000, 0x8000
+IN_ONLYDIR, IN_DONT_FOLLOW, IN_MASK_ADD, IN_ISDIR = 0x1000000, 0x2000000, 0x20000000, 0x40000000
+IN_MOVE = IN_MOVED_FROM | IN_MOVED_TO
+IN_NONBLOCK, IN_CLOEXEC = 04000, 02000000
+
+
+class INotify(object):
+
+	'''Minimal ctypes wrapper for linux inotify API,
+			with non-blocking fd, so that events can be checked on each collection cycle.
+		Raises OSError on init if inotify is not available.'''
+
+	_libc = None
+	_event = struct.Struct('iIII') # wd, mask, cookie, len
+
+	def __init__(self):
+		if not self._libc:
+			libc = ctypes.CDLL(find_library('c') or 'libc.so.6', use_errno=True)
+			if not hasattr(libc, 'inotify_init1'):
+				raise OSError(errno.ENOSYS, 'inotify is not supported by libc')
+			INotify._libc = libc
+		self.fd = self._call(self._libc.inotify_init1, IN_NONBLOCK | IN_CLOEXEC)
+		self.paths = dict() # wd -> path
+
+	def _call(self, func, *argz):
+		res = func(*argz)
+		if res < 0:
+			err = ctypes.get_errno()
+			raise OSError(err, os.strerror(err))
+		return res
+
+	def fileno(self): return self.fd
+
+	def close(self):
+		if self.fd is None: return
+		os.close(self.fd)
+		self.fd = None
+
+	def add_watch(self, path, mask):
+		wd = self._call(self._libc.inotify_add_watch, self.fd, path, mask)
+		self.paths[wd] = path
+		return wd
+
+	def rm_watch(self, wd):
+		self.paths.pop(wd, None)
+		self._call(self._libc.inotify_rm_watch, self.fd, wd)
+
+	def read(self, bs=2**16):
+		'''Returns list of (path, mask, cookie, name) tuples for all queued events,
+			empty one if there are none. Path is None for IN_Q_OVERFLOW events.'''
+		events, buff = list(), ''
+		while True:
+			try: chunk = os.read(self.fd, bs)
+			except OSError as err:
+				if err.errno == errno.EAGAIN: break
+				raise
+			if not chunk: break
+			buff += chunk
+		n, event_len = 0, self._event.size
+		while n < len(buff):
+			wd, mask, cookie, name_len = self._event.unpack_from(buff, n)
+			n += event_len
+			name, n = buff[n:n + name_len].rstrip('\0'), n + name_len
+			path = self.paths.get(wd)
+			if mask & IN_IGNORED: self.paths.pop(wd, None) # watch was removed
+			events.append((path, mask, cookie, name))
+		return events
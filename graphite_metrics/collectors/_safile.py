@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+
+import itertools as it, operator as op, functools as ft
+from collections import namedtuple
+from mmap import mmap, ACCESS_READ
+import os, struct
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class SAFormatError(Exception): pass
+
+
+# Record types
+R_STATS, R_RESTART, R_LAST_STATS, R_COMMENT = 1, 2, 3, 4
+MAX_COMMENT_LEN = 64
+
+# Activity ids, only ones used in SADF.process_entry are listed here
+A_PAGE, A_KTABLES, A_DISK = 5, 8, 11
+A_NET_DEV, A_NET_EDEV, A_NET_NFS, A_NET_NFSD, A_NET_SOCK = 12, 13, 14, 15, 16
+A_PWR_TEMP = 32
+
+
+class SAFile(object):
+
+	'''In-process reader for binary sysstat activity files (saNN),
+			as written by sadc from sysstat 12.x (data file format magic 0x2175).
+		File is mmap'ed and records are unpacked from there directly, yielding
+			same entries as "sadf -j" would (see SADF.process_entry), with values
+			calculated from deltas between consecutive records in the same way.
+		Every structure in this format has its field counts (long long, long, int)
+			recorded in the file, which are checked against known layouts (see "layouts"),
+			and SAFormatError is raised on any mismatch or unexpected data,
+			so that sadf can be used for such files instead.'''
+
+	magic = struct.Struct('=HHBBBBII3I') # magics, version, header_size, upgraded, hdr_types_nr
+	magic_size = magic.size + 48 # padding, reserved for future use
+	sysstat_magic, format_magic, version_min = 0xd596, 0x2175, 12
+
+	header = struct.Struct('=QQIIi3I3IIIIBBb65s65s') # up to sa_nodename
+	header_types = 1, 1, 12
+	activity = struct.Struct('=IIiiii3I') # id, magic, nr, nr2, has_nr, size, types_nr
+	activity_types = 0, 0, 9
+	record = struct.Struct('=QQIBBBB') # uptime_cs, ust_time, extra_next, type, h, m, s
+	record_types = 2, 0, 1
+	nr = struct.Struct('=i')
+
+	# Field names for known layouts (nr of long long, long and int fields) of activity structures
+	layouts = {
+		A_PAGE: dict.fromkeys( [(0, 8, 0), (8, 0, 0)], 'pgpgin pgpgout'
+			' pgfault pgmajfault pgfree pgscan_kswapd pgscan_direct pgsteal' ),
+		A_KTABLES: dict.fromkeys( [(0, 0, 4), (4, 0, 0)],
+			'file_used inode_used dentry_stat pty_nr' ),
+		A_DISK: {
+			(1, 2, 6): 'nr_ios rd_sect wr_sect rd_ticks wr_ticks tot_ticks rq_ticks major minor',
+			(1, 3, 12): 'nr_ios rd_sect wr_sect dc_sect rd_ticks wr_ticks tot_ticks'
+				' rq_ticks major minor dc_ticks wwn0 wwn1 wwn2 wwn3 part_nr' },
+		A_NET_DEV: {(7, 0, 1): 'rx_packets tx_packets rx_bytes'
+			' tx_bytes rx_compressed tx_compressed multicast speed'},
+		A_NET_EDEV: {(9, 0, 0): 'collisions rx_errors tx_errors rx_dropped tx_dropped'
+			' rx_fifo_errors tx_fifo_errors rx_frame_errors tx_carrier_errors'},
+		A_NET_NFS: {(0, 0, 6): 'rpccnt rpcretrans readcnt writecnt accesscnt getattcnt'},
+		A_NET_NFSD: {(0, 0, 11): 'rpccnt rpcbad netcnt netudpcnt nettcpcnt'
+			' rchits rcmisses readcnt writecnt accesscnt getattcnt'},
+		A_NET_SOCK: {(0, 0, 6): 'sock_inuse tcp_inuse tcp_tw udp_inuse raw_inuse frag_inuse'},
+		A_PWR_TEMP: {(3, 0, 0): 'temp temp_min temp_max'} }
+	layouts_double = {A_PWR_TEMP} # long long fields are actually doubles there
+
+	_act = namedtuple('SAActivity', 'id nr nr2 has_nr size item')
+
+	def __init__(self, path):
+		self.path, self.map = path, None
+		with open(path, 'rb') as src:
+			size = os.fstat(src.fileno()).st_size
+			if size < self.magic_size: raise SAFormatError('File is too small')
+			self.map = mmap(src.fileno(), size, access=ACCESS_READ)
+		try: self._read_header()
+		except:
+			self.close()
+			raise
+
+	def close(self):
+		if self.map is not None: self.map.close()
+		self.map = None
+
+	def __enter__(self): return self
+	def __exit__(self, *err): self.close()
+
+	def _read_header(self):
+		buff = self.map
+		magic, fmt, version, patch, sub, extra, header_size, upgraded,\
+			ht0, ht1, ht2 = self.magic.unpack_from(buff)
+		if magic != self.sysstat_magic or fmt != self.format_magic:
+			raise SAFormatError( 'Unsupported file magic:'
+				' {:#x} {:#x} (version: {}.{}.{})'.format(magic, fmt, version, patch, sub) )
+		if version < self.version_min:
+			raise SAFormatError('Unsupported sysstat version: {}.{}.{}'.format(version, patch, sub))
+		if (ht0, ht1, ht2) != self.header_types or header_size < self.header.size:
+			raise SAFormatError('Unknown file header layout: {}'.format((ht0, ht1, ht2)))
+		pos = self.magic_size
+		if len(buff) < pos + header_size: raise SAFormatError('Incomplete file header')
+		self.ts, hz, self.cpu_nr, act_nr, year, at0, at1, at2, rt0, rt1, rt2,\
+			act_size, rec_size, extra_next, day, month, long_size, sysname, nodename =\
+				self.header.unpack_from(buff, pos)
+		if (at0, at1, at2) != self.activity_types or act_size != self.activity.size\
+				or (rt0, rt1, rt2) != self.record_types or rec_size != self.record.size:
+			raise SAFormatError('Unknown activity/record structure layouts')
+		if extra_next: raise SAFormatError('Extra structures after file header are not supported')
+		if long_size != 8: raise SAFormatError('Files from 32-bit systems are not supported')
+		self.nodename = nodename.split('\0', 1)[0]
+		pos += header_size
+
+		self.acts = list()
+		if len(buff) < pos + act_nr * act_size: raise SAFormatError('Incomplete activity list')
+		for n in xrange(act_nr):
+			act_id, act_magic, nr, nr2, has_nr, size, t0, t1, t2 = self.activity.unpack_from(buff, pos)
+			pos += act_size
+			if size <= 0 or nr < 0 or nr2 < 0:
+				raise SAFormatError('Invalid activity structure: {}'.format(act_id))
+			item = self.layouts.get(act_id)
+			if item is not None:
+				types = t0, t1, t2
+				item = item.get(types)
+				if item is None:
+					raise SAFormatError('Unknown layout for activity {}: {}'.format(act_id, types))
+				tail = size - 8 * (t0 + t1) - 4 * t2
+				if tail < 0: raise SAFormatError('Invalid size for activity {}: {}'.format(act_id, size))
+				st = struct.Struct('={}{}{}{}s'.format(
+					('d' if act_id in self.layouts_double else 'Q') * t0, 'Q' * t1, 'I' * t2, tail ))
+				item = st, namedtuple('SAItem', item + ' name')
+			self.acts.append(self._act(act_id, nr, nr2, has_nr, size, item))
+		self.data_pos = pos
+
+	def _items(self, item, pos, count):
+		st, item = item
+		items = list()
+		for n in xrange(count):
+			vals = st.unpack_from(self.map, pos)
+			items.append(item(*(vals[:-1] + (vals[-1].split('\0', 1)[0],))))
+			pos += st.size
+		return items
+
+	def _record(self, pos):
+		'Returns unpacked record header at pos, raising SAFormatError if it looks invalid.'
+		rec = uptime, ts, extra, rtype, h, m, s = self.record.unpack_from(self.map, pos)
+		if rtype not in [R_STATS, R_RESTART, R_LAST_STATS, R_COMMENT]\
+				or h > 23 or m > 59 or s > 59 or (ts - (h*3600 + m*60 + s)) % 900\
+				or abs(ts - self.ts) > 2 * 24*3600:
+			raise SAFormatError('Invalid record header at offset {}: {}'.format(pos, rec))
+		if extra: raise SAFormatError('Extra structures in records are not supported')
+		return rec
+
+	def _stats(self, pos):
+		'''Returns (end offset, {activity_id: items}) for stats record data at pos,
+			or None if the record is incomplete (e.g. is being written by sadc).'''
+		buff, size, stats = self.map, len(self.map), dict()
+		for act in self.acts:
+			nr = act.nr
+			if act.has_nr:
+				if pos + self.nr.size > size: return None
+				nr, = self.nr.unpack_from(buff, pos)
+				pos += self.nr.size
+				if nr < 0: raise SAFormatError('Invalid item count at offset {}: {}'.format(pos, nr))
+			count = nr * act.nr2
+			if pos + count * act.size > size: return None
+			if act.item: stats[act.id] = self._items(act.item, pos, count)
+			pos += count * act.size
+		return pos, stats
+
+	def entries(self, pos=None, ts_min=0):
+		'''Yields (nodename, entry) for all stats records with timestamps after ts_min,
+				same as sadf_stream(), starting from a stats record at pos (if it's valid)
+				or from the first one, which are only used as a reference for the next one.
+			Offset of the last complete stats record is set as "pos" attribute,
+				and can be passed here to continue from there on the next run.'''
+		buff, size, rec_size = self.map, len(self.map), self.record.size
+		if pos and pos + rec_size <= size:
+			try:
+				if self._record(pos)[3] not in [R_STATS, R_LAST_STATS]: pos = None
+			except SAFormatError: pos = None
+		else: pos = None
+		self.pos, pos, prev = pos, pos or self.data_pos, None
+		while pos + rec_size <= size:
+			uptime, ts, extra, rtype, h, m, s = self._record(pos)
+			if rtype == R_RESTART:
+				pos, prev = pos + rec_size + self.nr.size, None
+				if pos > size: break
+				cpu_nr, = self.nr.unpack_from(buff, pos - self.nr.size)
+				if cpu_nr != self.cpu_nr:
+					if any( not act.has_nr and self.cpu_nr in [act.nr, act.nr2]
+						for act in self.acts ): raise SAFormatError('Number of cpus has changed')
+					self.cpu_nr = cpu_nr
+			elif rtype == R_COMMENT: pos += rec_size + MAX_COMMENT_LEN
+			else:
+				stats = self._stats(pos + rec_size)
+				if not stats: break
+				if prev and ts > ts_min and uptime > prev[0]:
+					yield self.nodename, self._entry(ts, (uptime - prev[0]) / 100.0, prev[1], stats[1])
+				prev, self.pos, pos = (uptime, stats[1]), pos, stats[0]
+
+	def _entry(self, ts, itv, prev, stats):
+		'Returns sadf-like entry for deltas between two stats records, itv seconds apart.'
+		entry = dict(timestamp=dict(ts=ts, interval=itv))
+
+		def pairs(act_id, key=op.attrgetter('name')):
+			'Yields (prev, cur) items for activity, matched by key, skipping ones with no prev.'
+			items = dict((key(item), item) for item in prev.get(act_id, list()))
+			for item in stats.get(act_id, list()):
+				item_prev = items.get(key(item))
+				if item_prev is not None: yield item_prev, item
+
+		def rates(p, c, fields):
+			return list((c[n] - p[n]) / itv for n in fields)
+
+		if A_DISK in stats:
+			entry['disk'] = disks = list()
+			for p, c in pairs(A_DISK, key=op.attrgetter('major', 'minor')):
+				ios, rd, wr, rd_ticks, wr_ticks, tot_ticks, rq_ticks = deltas = list(
+					getattr(c, k) - getattr(p, k) for k in [ 'nr_ios',
+						'rd_sect', 'wr_sect', 'rd_ticks', 'wr_ticks', 'tot_ticks', 'rq_ticks' ] )
+				if min(deltas) < 0: continue # counter reset
+				disks.append({
+					'disk-device': 'dev{}-{}'.format(c.major, c.minor),
+					'tps': ios / itv, 'rd_sec': rd / itv, 'wr_sec': wr / itv,
+					'avgrq-sz': float(rd + wr) / ios if ios else 0.0,
+					'avgqu-sz': rq_ticks / itv / 1000, 'util-percent': tot_ticks / itv / 10,
+					'await': float(rd_ticks + wr_ticks) / ios if ios else 0.0 })
+
+		if A_PAGE in stats:
+			for p, c in pairs(A_PAGE, key=lambda item: None):
+				scan = c.pgscan_kswapd - p.pgscan_kswapd + c.pgscan_direct - p.pgscan_direct
+				entry['paging'] = {'vmeff-percent':
+					(c.pgsteal - p.pgsteal) * 100.0 / scan if scan > 0 else 0.0}
+
+		if stats.get(A_KTABLES):
+			c = stats[A_KTABLES][0]
+			entry['kernel'] = { 'dentunusd': c.dentry_stat,
+				'file-nr': c.file_used, 'inode-nr': c.inode_used, 'pty-nr': c.pty_nr }
+
+		net = dict()
+		if A_NET_DEV in stats:
+			net['net-dev'] = ifaces = list()
+			for p, c in pairs(A_NET_DEV):
+				vals = rates(p, c, range(7))
+				if min(vals) < 0: continue # counter reset
+				vals[2] /= 2**10
+				vals[3] /= 2**10
+				ifaces.append(dict(
+					[('iface', c.name)] + zip([ 'rxpck', 'txpck', 'rxkB',
+						'txkB', 'rxcmp', 'txcmp', 'rxmcst' ], vals) ))
+		if A_NET_EDEV in stats:
+			net['net-edev'] = ifaces = list()
+			for p, c in pairs(A_NET_EDEV):
+				vals = rates(p, c, range(9))
+				if min(vals) < 0: continue
+				ifaces.append(dict(
+					[('iface', c.name)] + zip([ 'coll', 'rxerr', 'txerr', 'rxdrop', 'txdrop',
+						'rxfifo', 'txfifo', 'rxfram', 'txcarr' ], vals) ))
+		if A_NET_NFS in stats or A_NET_NFSD in stats:
+			for act_id, key, names in [
+					(A_NET_NFS, 'net-nfs', ['call', 'retrans', 'read', 'write', 'access', 'getatt']),
+					(A_NET_NFSD, 'net-nfsd', [ 'scall', 'badcall', 'packet', 'udp', 'tcp',
+						'hit', 'miss', 'sread', 'swrite', 'saccess', 'sgetatt' ]) ]:
+				net[key] = dict()
+				for p, c in pairs(act_id, key=lambda item: None):
+					net[key] = dict(zip(names, rates(p, c, range(len(names)))))
+		if stats.get(A_NET_SOCK):
+			c = stats[A_NET_SOCK][0]
+			net['net-sock'] = { 'totsck': c.sock_inuse, 'tcpsck': c.tcp_inuse,
+				'udpsck': c.udp_inuse, 'rawsck': c.raw_inuse, 'ip-frag': c.frag_inuse, 'tcp-tw': c.tcp_tw }
+		if net: entry['network'] = net
+
+		if A_PWR_TEMP in stats:
+			entry['power-management'] = {'temperature': list(
+				{'number': n, 'degC': c.temp, 'device': c.name}
+				for n, c in enumerate(stats[A_PWR_TEMP], 1) )}
+
+		return entry
@@ -1,40 +1,150 @@
 # -*- coding: utf-8 -*-
 
 import itertools as it, operator as op, functools as ft
-from collections import deque
 from contextlib import contextmanager
+from array import array
+from ctypes.util import find_library
+from time import time
 from io import open
-import os, re, dbus, fcntl, stat
+import os, re, errno, fcntl, stat, ctypes
 
 from . import Collector, Datapoint, user_hz, dev_resolve
+from . import _inotify
 
 import logging
 log = logging.getLogger(__name__)
 
 
+_libc = None
+O_CLOEXEC = 02000000
+
+def openat(dir_fd, path, flags=os.O_RDONLY):
+	'os.open() relative to a directory fd, as py2 os module lacks dir_fd support.'
+	global _libc
+	if _libc is None: _libc = ctypes.CDLL(find_library('c') or 'libc.so.6', use_errno=True)
+	fd = _libc.openat(dir_fd, path, flags | O_CLOEXEC)
+	if fd < 0:
+		err = ctypes.get_errno()
+		raise OSError(err, os.strerror(err), path)
+	return fd
+
+
+class IODeltas(object):
+
+	'''Last-seen [r, w, rc, wc] IO counters for pids or services, stored in
+			preallocated arrays (indexed via key -> slot dict) and updated in-place.
+		Each update is tagged with current generation (collection cycle),
+			and entries that weren't updated during the last one get evicted by next_generation().
+		New keys are not stored (counted in "dropped") when max_size entries are already there.'''
+
+	grow_min = 256 # slots
+
+	def __init__(self, max_size=None):
+		self.max_size, self.slots, self.keys, self.free = max_size, dict(), list(), list()
+		self.values, self.idents, self.gens = array('d'), array('l'), array('L')
+		self.generation = self.dropped = 0
+
+	def __len__(self): return len(self.slots)
+
+	def grow(self):
+		size = len(self.keys)
+		step = max(self.grow_min, size)
+		if self.max_size: step = max(1, min(step, self.max_size - size))
+		self.keys.extend(it.repeat(None, step))
+		self.values.extend(array('d', [0]) * (step * 4))
+		self.idents.extend(array('l', [0]) * step)
+		self.gens.extend(array('L', [0]) * step)
+		self.free.extend(xrange(size + step - 1, size - 1, -1))
+
+	def update(self, key, ident, vals):
+		'''Stores vals for key, returning deltas from the previously stored ones,
+			or None if there were none, if ident (e.g. hash of process name) has changed,
+			or if any of the counters went down (reset, e.g. recreated cgroup or dropped instance).'''
+		n, delta = self.slots.get(key), None
+		if n is None:
+			if self.max_size and len(self.slots) >= self.max_size:
+				self.dropped += 1
+				return
+			if not self.free: self.grow()
+			n = self.slots[key] = self.free.pop()
+			self.keys[n] = key
+		elif self.idents[n] == ident:
+			delta = list(v - v0 for v, v0 in it.izip(vals, self.values[n*4:n*4+4]))
+			if min(delta) < 0: delta = None
+		for m, v in enumerate(vals, n*4): self.values[m] = v
+		self.idents[n], self.gens[n] = ident, self.generation
+		return delta
+
+	def next_generation(self):
+		'Evicts entries that were not updated in the current generation, and starts the next one.'
+		gen, keys, gens, evicted = self.generation, self.keys, self.gens, 0
+		for n, key in enumerate(keys):
+			if key is None or gens[n] == gen: continue
+			del self.slots[key]
+			keys[n] = None
+			self.free.append(n)
+			evicted += 1
+		if evicted: log.debug('IO deltas cache cleanup: {} entries'.format(evicted))
+		if self.dropped:
+			log.warn(( 'IO deltas cache size limit ({}) reached,'
+				' dropped {} entries' ).format(self.max_size, self.dropped))
+		self.generation = (gen + 1) % 2**32
+		self.dropped = 0
+
+
 class CGAcct(Collector):
 
+	_cg_watch_mask = _inotify.IN_CREATE | _inotify.IN_DELETE\
+		| _inotify.IN_MOVE | _inotify.IN_ONLYDIR
+
+	# cgroup v2 stat files and controllers required for these, if any
+	cg2_rc_files = dict(cpuacct='cpu.stat', memory='memory.stat', blkio='io.stat')
+	cg2_rc_controllers = dict(cpuacct=None, memory='memory', blkio='io')
+
 
 	def __init__(self, *argz, **kwz):
 		super(CGAcct, self).__init__(*argz, **kwz)
 
 		self.stuck_list = os.path.join(self.conf.cg_root, 'sticky.cgacct')
+		cg2_controllers = os.path.join(self.conf.cg_root, 'cgroup.controllers')
+		self.v2 = self.conf.get('version') == 2\
+			or (not self.conf.get('version') and os.path.exists(cg2_controllers))
 
 		# Check which info is available, if any
-		self.rc_collectors = list()
-		for rc in self.conf.resource_controllers:
-			try: rc_collector = getattr(self, rc)
-			except AttributeError:
-				log.warn( 'Unable to find processor'
-					' method for rc {!r} metrics, skipping it'.format(rc) )
-				continue
-			rc_path = os.path.join(self.conf.cg_root, rc)
-			if not os.path.ismount(rc_path + '/'):
-				log.warn(( 'Specified rc path ({}) does not'
-					' seem to be a mountpoint, skipping it' ).format(rc_path))
-				continue
-			log.debug('Using cgacct collector for rc: {}'.format(rc))
-			self.rc_collectors.append(rc_collector)
+		self.rcs, self.rc_collectors = list(), list()
+		if self.v2:
+			with open(cg2_controllers, 'rb') as src: controllers = set(src.read().split())
+			for rc in self.conf.resource_controllers:
+				if rc not in self.cg2_rc_files:
+					log.warn('Unknown rc {!r} for cgroup v2 metrics, skipping it'.format(rc))
+					continue
+				controller = self.cg2_rc_controllers[rc]
+				if controller and controller not in controllers:
+					log.warn(( 'Controller {!r} for rc {!r} is not enabled'
+						' in cgroup v2 hierarchy, skipping it' ).format(controller, rc))
+					continue
+				log.debug('Using cgroup v2 stats for rc: {}'.format(rc))
+				self.rcs.append(rc)
+			if self.rcs:
+				self.cg2_files = ['cgroup.procs', 'cgroup.threads']\
+					+ list(self.cg2_rc_files[rc] for rc in self.rcs)
+				self.rc_collectors.append(self.cgroup2)
+
+		else:
+			for rc in self.conf.resource_controllers:
+				try: rc_collector = getattr(self, rc)
+				except AttributeError:
+					log.warn( 'Unable to find processor'
+						' method for rc {!r} metrics, skipping it'.format(rc) )
+					continue
+				rc_path = os.path.join(self.conf.cg_root, rc)
+				if not os.path.ismount(rc_path + '/'):
+					log.warn(( 'Specified rc path ({}) does not'
+						' seem to be a mountpoint, skipping it' ).format(rc_path))
+					continue
+				log.debug('Using cgacct collector for rc: {}'.format(rc))
+				self.rcs.append(rc)
+				self.rc_collectors.append(rc_collector)
 
 		if not self.rc_collectors: # no point doing anything else
 			log.info('No cgroup rcs to poll (rc_collectors), disabling collector')
@@ -42,14 +152,27 @@ class CGAcct(Collector):
 			return
 
 		# List of cgroup sticky bits, set by this service
-		self._stuck_list_file = open(self.stuck_list, 'ab+')
-		self._stuck_list = dict()
-		fcntl.lockf(self._stuck_list_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
-		self._stuck_list_file.seek(0)
-		for line in self._stuck_list_file:
-			rc, svc = line.strip().split()
-			if rc not in self._stuck_list: self._stuck_list[rc] = set()
-			self._stuck_list[rc].add(svc)
+		# cgroup v2 cgroups are always removed by systemd, so not used there
+		if not self.v2:
+			self._stuck_list_file = open(self.stuck_list, 'ab+')
+			self._stuck_list = dict()
+			fcntl.lockf(self._stuck_list_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+			self._stuck_list_file.seek(0)
+			for line in self._stuck_list_file:
+				rc, svc = line.strip().split()
+				if rc not in self._stuck_list: self._stuck_list[rc] = set()
+				self._stuck_list[rc].add(svc)
+
+		self.io_deltas = IODeltas(self.conf.io.cache_size)
+
+		# Service cgroups index, shared between rcs and
+		#  only rebuilt on cgroup tree changes (detected via inotify)
+		self.cg_index, self.cg_index_ts, self.cg_watch = None, 0, None
+		if self.conf.discovery.inotify:
+			try: self.cg_watch = _inotify.INotify()
+			except OSError as err:
+				log.warn(( 'Failed to init inotify, services will be'
+					' listed from systemd on every cycle: {}' ).format(err))
 
 
 	def _cg_svc_dir(self, rc, svc=None):
@@ -74,9 +197,13 @@ class CGAcct(Collector):
 	@staticmethod
 	def _svc_name(svc): return svc.replace('@', '').replace('.', '_')
 
+	@staticmethod
+	def _svc_group(svc): return svc.rsplit('@', 1)[0]+'@' if '@' in svc else svc
+
 
 	@staticmethod
 	def _systemd_services():
+		import dbus
 		for unit in dbus.Interface( dbus.SystemBus().get_object(
 					'org.freedesktop.systemd1', '/org/freedesktop/systemd1' ),
 				'org.freedesktop.systemd1.Manager' ).ListUnits():
@@ -84,6 +211,10 @@ class CGAcct(Collector):
 			if name.endswith('.service') and state in ('running', 'start'): yield name[:-8]
 
 	def _systemd_cg_stick(self, rc, services):
+		'''Makes cgroups of specified services sticky, unsticking/removing
+				ones for services that are no longer running.
+			Returns (services, stuck_update) tuple, with services set filtered
+				to only ones that have cgroups, stuck_update=True if stuck-list was changed.'''
 		if rc not in self._stuck_list: self._stuck_list[rc] = set()
 		stuck_update, stuck = False, set(self._stuck_list[rc])
 		services = set(services) # will be filtered and returned
@@ -115,20 +246,85 @@ class CGAcct(Collector):
 					log.debug('Failed to unstick cgroup tasks file: {}'.format(svc_tasks))
 			self._stuck_list[rc].remove(svc)
 			stuck_update = True
-		# Save list updates, if any
-		if stuck_update:
-			self._stuck_list_file.seek(0)
-			self._stuck_list_file.truncate()
-			for rc, stuck in self._stuck_list.viewitems():
-				for svc in stuck: self._stuck_list_file.write('{} {}\n'.format(rc, svc))
-			self._stuck_list_file.flush()
-		return services
+		return services, stuck_update
 
-	_systemd_sticky_instances = lambda self, rc, services: (
-		(self._svc_name(svc), list(svc_instances))
-		for svc, svc_instances in it.groupby(
-			sorted(set(services).intersection(self._systemd_cg_stick(rc, services))),
-			key=lambda k: (k.rsplit('@', 1)[0]+'@' if '@' in k else k) ) )
+	def _stuck_list_save(self):
+		self._stuck_list_file.seek(0)
+		self._stuck_list_file.truncate()
+		for rc, stuck in self._stuck_list.viewitems():
+			for svc in stuck: self._stuck_list_file.write('{} {}\n'.format(rc, svc))
+		self._stuck_list_file.flush()
+
+	def _cg_watch_update(self):
+		'''Adds inotify watches for dirs where service cgroups are created/removed by systemd:
+			"system" and templated services' dirs for v1, all slices in v2_slice tree for v2.'''
+		if not self.v2:
+			path = os.path.join(self._cg_svc_dir(self.rcs[0]), 'system')
+			paths = [path] + list( os.path.join(path, name)
+				for name in os.listdir(path) if name.endswith('@.service') )
+		else: paths = self.cg2_slices
+		for path in paths:
+			try: self.cg_watch.add_watch(path, self._cg_watch_mask)
+			except OSError as err:
+				if err.errno != errno.ENOENT: raise # removed since listdir
+
+	def _cg2_services(self):
+		'''Returns [(svc_metric_name, [cgroup_path, ...]), ...] list for
+				services in v2_slice tree, recursing into nested slices.
+			List of slice dirs is stored in cg2_slices, to be watched for changes.'''
+		services, self.cg2_slices = list(), list()
+		paths = [os.path.join(self.conf.cg_root, self.conf.v2_slice)]
+		while paths:
+			path = paths.pop()
+			try: names = os.listdir(path)
+			except OSError: continue # slice was removed
+			self.cg2_slices.append(path)
+			for name in names:
+				if name.endswith('.slice'): paths.append(os.path.join(path, name))
+				elif name.endswith('.service'):
+					services.append((name[:-8], os.path.join(path, name)))
+		return list(
+			(self._svc_name(svc), list(it.imap(op.itemgetter(1), svc_instances)))
+			for svc, svc_instances in it.groupby( sorted(services),
+				key=lambda svc: self._svc_group(svc[0]) ) )
+
+	def services(self):
+		'''Returns [(svc_metric_name, [svc_instance, ...]), ...] list of sticky
+				service cgroups (cgroup paths instead of instances for v2),
+				shared between all rcs and cached between cycles.
+			Services are only re-listed from systemd when cgroup tree changes,
+				or once per discovery.resync_interval, to pick up stopped ones.'''
+		ts_now = time()
+		if self.cg_index is not None and self.cg_watch:
+			try: events = self.cg_watch.read() # drained before listing
+			except OSError as err:
+				log.warn('Failed to read cgroup tree inotify events: {}'.format(err))
+				events = True
+			if events: log.debug('Detected cgroup tree changes, re-listing services')
+			elif ts_now < self.cg_index_ts + self.conf.discovery.resync_interval:
+				return self.cg_index
+
+		if not self.v2:
+			services, stuck_update = set(self._systemd_services()), False
+			cg_services = set()
+			for rc in self.rcs:
+				rc_services, rc_update = self._systemd_cg_stick(rc, services)
+				cg_services.update(rc_services)
+				stuck_update = stuck_update or rc_update
+			if stuck_update: self._stuck_list_save()
+			self.cg_index = list(
+				(self._svc_name(svc), list(svc_instances))
+				for svc, svc_instances in it.groupby(sorted(cg_services), key=self._svc_group) )
+		else: self.cg_index = self._cg2_services()
+		self.cg_index_ts = ts_now
+		if self.cg_watch:
+			try: self._cg_watch_update()
+			except OSError as err:
+				log.warn(( 'Failed to set inotify watches on cgroup'
+					' tree, disabling these: {}' ).format(err))
+				self.cg_watch.close()
+				self.cg_watch = None
+		return self.cg_index
 
 
 	def cpuacct( self, services,
@@ -138,7 +334,7 @@ class CGAcct(Collector):
 		##  yielded values are in seconds, so counter should have 0-1 range,
 		##  when divided by the interval
 		## Not parsed: usage (should be sum of percpu)
-		for svc, svc_instances in self._systemd_sticky_instances('cpuacct', services):
+		for svc, svc_instances in services:
 			if svc == 'total':
 				log.warn('Detected service name conflict with "total" aggregation')
 				continue
@@ -187,23 +383,43 @@ class CGAcct(Collector):
 		except KeyError:
 			raise OSError('Incomplete IO data for pid {}'.format(pid))
 		# comm is used to make sure it's the same process
-		return open('/proc/{}/comm'.format(pid), 'rb').read(), res
+		return open('/proc/{}/comm'.format(pid), 'rb').read().strip(), res
 
 	@staticmethod
 	def _read_ids(src):
 		return set(it.imap(int, it.ifilter( None,
 			it.imap(str.strip, src.readlines()) )))
 
+	def _svc_io( self, svc, pids, totals,
+			_name = 'processes.services.{}.io.{}'.format ):
+		'''Yields per-cycle deltas of io.{bytes,ops}_{read,write} for a service, from either
+				cgroup-level [r, w, rc, wc] totals or /proc/<pid>/io of its processes (io.source=pids).
+			Only up to io.max_pids processes are checked, lowest pids (same ones each cycle) first.'''
+		deltas = list()
+		if self.conf.io.source == 'pids':
+			## Syscall IO, should be very inaccurate if pids are respawning
+			max_pids = self.conf.io.max_pids
+			if max_pids and len(pids) > max_pids: pids = sorted(pids)[:max_pids]
+			for pid in pids:
+				try: comm, res = self._iostat(pid)
+				except (OSError, IOError): continue
+				deltas.append(self.io_deltas.update(pid, hash((svc, comm)), res))
+		elif totals is not None: deltas.append(self.io_deltas.update(svc, 0, totals))
+		delta_total = list(it.repeat(0, 4))
+		for delta in deltas:
+			if delta is not None: delta_total = map(op.add, delta, delta_total)
+		for k,v in it.izip(['bytes_read', 'bytes_write', 'ops_read', 'ops_write'], delta_total):
+			yield Datapoint(_name(svc, k), 'gauge', v, None)
+
+	def _io_deltas_stats(self):
+		self.io_deltas.next_generation()
+		yield Datapoint('harvestd.cgacct.io_deltas.entries', 'gauge', len(self.io_deltas), None)
+
 	def blkio( self, services,
-			_caches=deque([dict()], maxlen=2),
 			_re_line = re.compile( r'^(?P<dev>\d+:\d+)\s+'
 				r'(?P<iotype>Read|Write)\s+(?P<count>\d+)$' ),
 			_name = 'processes.services.{}.io.{}'.format ):
-		# Caches are for syscall io
-		cache_prev = _caches[-1]
-		cache_update = dict()
-
-		for svc, svc_instances in self._systemd_sticky_instances('blkio', services):
+		for svc, svc_instances in services:
 
 			## Block IO
 			## Only reads/writes are accounted, sync/async is meaningless now,
@@ -235,10 +451,21 @@ class CGAcct(Collector):
 						yield Datapoint(_name( svc,
 							'blkio.{}.{}_{}'.format(dev, metric, k) ), 'counter', v, None)
 
-			## Syscall IO
-			## Counters from blkio seem to be less useful in general,
-			##  so /proc/*/io stats are collected for all processes in cgroup
-			## Should be very inaccurate if pids are respawning
+			## Total IO
+			## Per-cgroup counters from throttling layer (accounted for all devices
+			##  and io schedulers), or /proc/*/io stats for all processes in cgroup (io.source=pids)
+			totals = None
+			if self.conf.io.source != 'pids':
+				totals = list(it.repeat(0, 4)) # r, w, rc, wc
+				for n, src in [(0, 'throttle.io_service_bytes'), (2, 'throttle.io_serviced')]:
+					for path in self._cg_svc_metrics('blkio', src, svc_instances):
+						try:
+							with self._cg_metric(path) as src:
+								for line in src:
+									match = _re_line.search(line.strip())
+									if not match: continue
+									totals[n + (match.group('iotype') == 'Write')] += int(match.group('count'))
+						except (OSError, IOError): pass
 			tids, pids = set(), set()
 			for base in it.imap(ft.partial(
 					self._cg_svc_dir, 'blkio' ), svc_instances):
@@ -254,26 +481,13 @@ class CGAcct(Collector):
 			yield Datapoint( 'processes.services.'
 				'{}.processes'.format(svc), 'gauge', len(pids), None )
 
-			# Actual io metrics
-			svc_update = list()
-			for pid in pids:
-				try: comm, res = self._iostat(pid)
-				except (OSError, IOError): continue
-				svc_update.append(((svc, pid, comm), res))
-			delta_total = list(it.repeat(0, 4))
-			for k,res in svc_update:
-				try: delta = map(op.sub, res, cache_prev[k])
-				except KeyError: continue
-				delta_total = map(op.add, delta, delta_total)
-			for k,v in it.izip(['bytes_read', 'bytes_write', 'ops_read', 'ops_write'], delta_total):
-				yield Datapoint(_name(svc, k), 'gauge', v, None)
-			cache_update.update(svc_update)
-		_caches.append(cache_update)
+			for dp in self._svc_io(svc, pids, totals): yield dp
+		for dp in self._io_deltas_stats(): yield dp
 
 
 	def memory( self, services,
 			_name = 'processes.services.{}.memory.{}'.format ):
-		for svc, svc_instances in self._systemd_sticky_instances('memory', services):
+		for svc, svc_instances in services:
 			vals = dict()
 			for path in self._cg_svc_metrics('memory', 'stat', svc_instances):
 				try:
@@ -291,8 +505,94 @@ class CGAcct(Collector):
 				yield Datapoint(name, val_type, val, None)
 
 
+	@staticmethod
+	def _cg2_read(path, names, bs=2**16):
+		'''Yields (name, contents) for specified files in a cgroup dir,
+			opening these relative to dir fd, instead of looking up full path for each.'''
+		try: dir_fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+		except OSError as err:
+			log.debug('Failed to open cgroup: {} ({})'.format(path, err))
+			return
+		try:
+			for name in names:
+				try:
+					fd = openat(dir_fd, name)
+					try:
+						data = list(iter(ft.partial(os.read, fd, bs), ''))
+						data = data[0] if len(data) == 1 else ''.join(data)
+					finally: os.close(fd)
+				except OSError as err:
+					log.debug('Failed to read cgroup metric: {}/{} ({})'.format(path, name, err))
+					continue
+				yield name, data
+		finally: os.close(dir_fd)
+
+	def cgroup2( self, services,
+			_name = 'processes.services.{}.{}'.format,
+			_cpu=dict( user_usec=('user', 1e-6),
+				system_usec=('system', 1e-6), usage_usec=('usage', 1000) ),
+			_io=dict( rbytes=('bytes_read', 0), wbytes=('bytes_write', 1),
+				rios=('ops_read', 2), wios=('ops_write', 3) ),
+			_mem=dict( anon='rss', file='cache', anon_thp='rss_huge',
+				file_mapped='mapped_file', file_dirty='dirty', file_writeback='writeback' ),
+			_mem_counters=('pg', 'workingset_', 'thp_', 'zswp') ):
+		## All stats for each service are read in one pass over its cgroup dir(s)
+		## Metric names and units are same as for v1 stats,
+		##  except for blkio io_service_time, which has no v2 equivalent
+		## memory.stat keys are renamed to v1 ones where these match (e.g. anon -> rss),
+		##  others (e.g. slab, workingset_*) are passed as-is, event counts as counters
+		io_pids = 'blkio' in self.rcs and self.conf.io.source == 'pids'
+		for svc, cg_paths in services:
+			if svc == 'total':
+				log.warn('Detected service name conflict with "total" aggregation')
+				continue
+			vals, tids, pids, svc_pids = dict(), 0, 0, set()
+			io_totals = list(it.repeat(0, 4)) if 'blkio' in self.rcs else None
+			for path in cg_paths:
+				for name, data in self._cg2_read(path, self.cg2_files):
+					if name == 'cgroup.procs':
+						pids += data.count('\n')
+						if io_pids: svc_pids.update(it.imap(int, data.split()))
+					elif name == 'cgroup.threads': tids += data.count('\n')
+					elif name == 'cpu.stat':
+						for line in data.splitlines():
+							k, v = line.split()
+							try: k, m = _cpu[k]
+							except KeyError: continue
+							k = 'cpu.{}'.format(k), 'counter'
+							vals[k] = vals.get(k, 0) + int(v) * m
+					elif name == 'memory.stat':
+						for line in data.splitlines():
+							k, v = line.split()
+							k = 'memory.{}'.format(_mem.get(k, k)),\
+								'gauge' if not k.startswith(_mem_counters) else 'counter'
+							vals[k] = vals.get(k, 0) + int(v)
+					elif name == 'io.stat':
+						for line in data.splitlines():
+							dev, stats = line.split(None, 1)
+							dev = dev_resolve(*map(int, dev.split(':')))
+							for kv in stats.split():
+								k, v = kv.split('=', 1)
+								try: k, n = _io[k]
+								except KeyError: continue
+								v = int(v)
+								io_totals[n] += v
+								if dev is None: continue
+								k = 'io.blkio.{}.{}'.format(dev, k), 'counter'
+								vals[k] = vals.get(k, 0) + v
+			for (name, val_type), val in vals.viewitems():
+				if not val and name.startswith('io.'): continue # lots of always-zero devices
+				yield Datapoint(_name(svc, name), val_type, val, None)
+			yield Datapoint(_name(svc, 'threads'), 'gauge', tids, None)
+			yield Datapoint(_name(svc, 'processes'), 'gauge', pids, None)
+			if io_totals is not None:
+				for dp in self._svc_io(svc, svc_pids, io_totals): yield dp
+		if 'blkio' in self.rcs:
+			for dp in self._io_deltas_stats(): yield dp
+
+
 	def read(self):
-		services = list(self._systemd_services())
+		services = self.services()
 		for dp in it.chain.from_iterable(
 			func(services) for func in self.rc_collectors ): yield dp
 
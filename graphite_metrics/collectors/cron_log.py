@@ -1,15 +1,118 @@
 # -*- coding: utf-8 -*-
 
 import itertools as it, operator as op, functools as ft
+from collections import OrderedDict
 import re, iso8601, calendar
 
 from . import Collector, Datapoint
+from ._checkpoints import Checkpoints
 
 import logging
 log = logging.getLogger(__name__)
 
 
-def file_follow( src, open_tail=True,
+def file_follow(src, inotify=True, **follow_kwz):
+	'''Returns generator, yielding lines appended to a file (path or file object).
+		With read_interval_min=None, empty string is yielded when
+			there's no new data in the file, instead of waiting for it.
+		With yield_file=True, (line, file_object, pos) tuples are yielded instead,
+			where pos is the offset right after the line in the file object.
+		inotify-based follower is used, if enabled and available,
+			falling back to polling file with exponential backoff otherwise.'''
+	if inotify:
+		from ._inotify import INotify
+		try: inotify = INotify()
+		except OSError as err:
+			log.warn('Failed to init inotify, falling back to polling log file: {}'.format(err))
+		else: return file_follow_inotify(src, inotify, **follow_kwz)
+	return file_follow_poll(src, **follow_kwz)
+
+
+def file_follow_inotify( src, inotify, open_tail=True,
+		read_interval_min=0.1, read_interval_max=20, read_interval_mul=None,
+		rotation_check_interval=20, yield_file=False, read_bs=2**16, **open_kwz ):
+	'''File is only read on IN_MODIFY events, in read_bs chunks, with all complete
+			lines from these yielded in order, and re-opened on EOF after path is moved,
+			removed or re-created (as detected from events on it and parent dir).
+		rotation_check_interval is used for periodic re-check of both,
+			in case of missed events, and read_interval_max - as max time to wait for them.'''
+	from ._inotify import IN_MODIFY, IN_ATTRIB, IN_MOVE_SELF,\
+		IN_DELETE_SELF, IN_IGNORED, IN_CREATE, IN_DELETE, IN_MOVE, IN_Q_OVERFLOW
+	from select import select
+	from time import time
+	from io import open
+	import os, types
+
+	if isinstance(src, types.StringTypes): path = src
+	else: path, open_tail = src.name, False
+	path_dir, path_name = os.path.split(os.path.abspath(path))
+	sanity_chk_stats = lambda stat: (stat.st_ino, stat.st_dev)
+	sanity_chk_ts = lambda ts=None: (ts or time()) + rotation_check_interval
+
+	inotify.add_watch(path_dir, IN_CREATE | IN_DELETE | IN_MOVE)
+	src_mask = IN_MODIFY | IN_ATTRIB | IN_MOVE_SELF | IN_DELETE_SELF
+	src_wd = src_inode = None
+	buff, dirty, rotated, check_ts = '', True, False, sanity_chk_ts()
+
+	try:
+		while True:
+
+			if src_wd is None: # (re)open
+				if isinstance(src, types.StringTypes):
+					src = open(path, mode='rb', **open_kwz)
+					if open_tail:
+						src.seek(0, os.SEEK_END)
+						open_tail = False
+				src_wd = inotify.add_watch(path, src_mask)
+				src_inode = sanity_chk_stats(os.fstat(src.fileno()))
+				pos = src.tell() # offset of the first byte in buff
+
+			if dirty:
+				if os.fstat(src.fileno()).st_size < src.tell(): # truncated
+					src.seek(0)
+					buff, pos = '', 0
+				while True:
+					chunk = src.read(read_bs)
+					if not chunk: break
+					lines = (buff + chunk).split('\n')
+					buff = lines.pop()
+					for line in lines:
+						line += '\n'
+						pos += len(line)
+						if (yield (line if not yield_file else (line, src, pos))) is not None: return
+				dirty = False
+
+			if rotated: # eof after rotation event
+				try: src_inode_chk = sanity_chk_stats(os.stat(path))
+				except OSError: src_inode_chk = None # not re-created yet
+				if src_inode_chk and src_inode_chk != src_inode:
+					try: inotify.rm_watch(src_wd)
+					except OSError: pass # already removed along with the file
+					src.close()
+					src, src_wd, buff, dirty = path, None, '', True
+				rotated = False
+				continue
+
+			if read_interval_min is None:
+				if (yield ('' if not yield_file else ('', src, pos))) is not None: return
+			else: select([inotify], [], [], read_interval_max)
+
+			for ev_path, mask, cookie, name in inotify.read():
+				if mask & IN_Q_OVERFLOW: dirty = rotated = True
+				elif ev_path == path_dir:
+					if name == path_name: rotated = True
+				elif ev_path == path:
+					dirty = True
+					if mask & (IN_ATTRIB | IN_MOVE_SELF | IN_DELETE_SELF | IN_IGNORED): rotated = True
+			ts = time()
+			if ts > check_ts: dirty, rotated, check_ts = True, True, sanity_chk_ts(ts)
+
+	finally:
+		if not isinstance(src, types.StringTypes): src.close()
+		inotify.close()
+
+
+def file_follow_poll( src, open_tail=True,
 		read_interval_min=0.1,
 			read_interval_max=20, read_interval_mul=1.1,
 		rotation_check_interval=20, yield_file=False, **open_kwz ):
@@ -55,7 +158,7 @@ def file_follow( src, open_tail=True,
 				src, line = None, ''
 				continue
 			if read_chk is None:
-				yield (buff if not yield_file else (buff, src))
+				yield (buff if not yield_file else (buff, src, src.tell()))
 			else:
 				sleep(read_chk)
 				read_chk *= read_interval_mul
@@ -67,7 +170,7 @@ def file_follow( src, open_tail=True,
 
 		if line and line[-1] == '\n': # complete line
 			try:
-				val = yield (line if not yield_file else (line, src))
+				val = yield (line if not yield_file else (line, src, src.tell()))
 				if val is not None: raise KeyboardInterrupt
 			except KeyboardInterrupt: break
 			line = ''
@@ -75,61 +178,28 @@ def file_follow( src, open_tail=True,
 	src.close()
 
 
-def file_follow_durable( path,
-		min_dump_interval=10,
+def file_follow_durable( path, checkpoints=None, min_dump_interval=10,
 		xattr_name='user.collectd.logtail.pos', xattr_update=True,
-		**follow_kwz ):
-	'''Records log position into xattrs after reading line every
-			min_dump_interval seconds.
-		Checksum of the last line at the position
-			is also recorded (so line itself don't have to fit into xattr) to make sure
-			file wasn't truncated between last xattr dump and re-open.'''
-
-	from xattr import xattr
+		inotify=True, **follow_kwz ):
+	'''Follows file from the position, recorded in Checkpoints object,
+			updating it after each line read, and flushing these updates
+			on EOF (with read_interval_min=None), if min_dump_interval has passed.
+		If checkpoints object isn't passed, one that stores position
+			in xattr_name xattr of the file (if set) is created.'''
+
 	from io import open
-	from hashlib import sha1
-	from time import time
-	import struct
 
-	# Try to restore position
+	if checkpoints is None:
+		checkpoints = Checkpoints(xattr_name=xattr_name, dry_run=not xattr_update)
+
 	src = open(path, mode='rb')
-	src_xattr = xattr(src)
-	try:
-		if not xattr_name: raise KeyError
-		pos = src_xattr[xattr_name]
-	except KeyError: pos = None
-	if pos:
-		data_len = struct.calcsize('=I')
-		(pos,), chksum = struct.unpack('=I', pos[:data_len]), pos[data_len:]
-		(data_len,), chksum = struct.unpack('=I', chksum[:data_len]), chksum[data_len:]
-		try:
-			src.seek(pos - data_len)
-			if sha1(src.read(data_len)).digest() != chksum:
-				raise IOError('Last log line doesnt match checksum')
-		except (OSError, IOError) as err:
-			collectd.info('Failed to restore log position: {}'.format(err))
-			src.seek(0)
-	tailer = file_follow(src, yield_file=True, **follow_kwz)
-
-	# ...and keep it updated
-	pos_dump_ts_get = lambda ts=None: (ts or time()) + min_dump_interval
-	pos_dump_ts = pos_dump_ts_get()
+	checkpoints.restore(path, src)
+	tailer = file_follow(src, inotify=inotify, yield_file=True, **follow_kwz)
+
 	while True:
-		line, src_chk = next(tailer)
-		if not line: pos_dump_ts = 0 # force-write xattr
-		ts = time()
-		if ts > pos_dump_ts:
-			if src is not src_chk:
-				src, src_xattr = src_chk, xattr(src_chk)
-			pos_new = src.tell()
-			if pos != pos_new:
-				pos = pos_new
-				if xattr_update:
-					src_xattr[xattr_name] =\
-						struct.pack('=I', pos)\
-						+ struct.pack('=I', len(line))\
-						+ sha1(line).digest()
-			pos_dump_ts = pos_dump_ts_get(ts)
+		line, src, pos = next(tailer)
+		if line: checkpoints.update(path, src, pos, line)
+		else: checkpoints.flush(min_dump_interval)
 		if (yield line.decode('utf-8', 'replace')):
 			tailer.send(StopIteration)
 			break
@@ -155,41 +225,93 @@ class CronJobs(Collector):
 			self.conf.enabled = False
 			return
 
-		for k,v in self.lines.viewitems(): self.lines[k] = re.compile(v)
+		self.lines_re = self.lines_combine(self.lines)
+		for k,v in self.lines.viewitems(): self.lines[k] = v and re.compile(v)
 		for idx,(k,v) in enumerate(self.aliases): self.aliases[idx] = k, re.compile(v)
-		self.log_tailer = file_follow_durable( src, read_interval_min=None,
-			xattr_name=self.conf.xattr_name, xattr_update=not self.conf.debug.dry_run )
+		self.alias_cache, self.alias_cache_size = OrderedDict(), self.conf.get('alias_cache_size', 1000)
+		self.checkpoints = Checkpoints( path=self.conf.get('state_file'),
+			xattr_name=self.conf.xattr_name, dry_run=self.conf.debug.dry_run )
+		self.log_tailer = file_follow_durable( src, self.checkpoints,
+			min_dump_interval=self.conf.get('checkpoint_interval', 10),
+			read_interval_min=None, inotify=self.conf.get('inotify', True) )
+
+	@staticmethod
+	def lines_combine( lines,
+			_re_group=re.compile(r'\(\?P<(\w+)>'), _re_backref=re.compile(r'\(\?P=|\\\d|\(\?[a-zA-Z]+\)') ):
+		'''Returns (regexp, events) tuple, where regexp has all line patterns as
+				optional lookaheads from the start of the line, so that one match() call
+				finds all of these, with named groups prefixed by "{event_id}__".
+			Returns None if patterns can't be combined this way (e.g. use backreferences or flags).'''
+		events, patterns = list(), list()
+		for n, (ev, regex) in enumerate(sorted(lines.viewitems())):
+			if not regex: continue
+			if _re_backref.search(regex): return None
+			groups = set(_re_group.findall(regex))
+			regex = _re_group.sub(r'(?P<e{}__\1>'.format(n), regex)
+			patterns.append('(?=.*?(?P<e{0}>{1}))?'.format(n, regex))
+			events.append((ev, 'e{}'.format(n), 'e{}__job'.format(n), 'val' in groups and 'e{}__val'.format(n)))
+		try: return re.compile(''.join(patterns)), events
+		except re.error as err:
+			log.warn('Failed to combine line patterns, will match these one-by-one: {}'.format(err))
+			return None
+
+	def lines_match(self, line):
+		'Returns list of (event, job, value) for all line patterns matching the line.'
+		matches = list()
+		if self.lines_re:
+			regex, events = self.lines_re
+			match = regex.match(line)
+			for ev, g_ev, g_job, g_val in events:
+				if match.group(g_ev) is None: continue
+				matches.append((ev, match.group(g_job), float(match.group(g_val)) if g_val else 1))
+		else:
+			for ev, regex in self.lines.viewitems():
+				if not regex: continue
+				match = regex.search(line)
+				if not match: continue
+				try: value = float(match.group('val'))
+				except IndexError: value = 1
+				matches.append((ev, match.group('job'), value))
+		return matches
+
+	def alias(self, job, _re_sanitize=re.compile('\s+|-')):
+		'Returns alias for a job string (or None), caching results for alias_cache_size last ones.'
+		try:
+			alias = self.alias_cache.pop(job)
+			self.alias_cache[job] = alias # move to the end
+			return alias
+		except KeyError: pass
+		for alias, regex in self.aliases:
+			group = alias[1:] if alias.startswith('_') else None
+			alias_match = regex.search(job)
+			if alias_match:
+				if group is not None:
+					alias = _re_sanitize.sub('_', alias_match.group(group))
+				break
+		else: alias = None
+		self.alias_cache[job] = alias
+		if len(self.alias_cache) > self.alias_cache_size: self.alias_cache.popitem(last=False)
+		return alias
 
-	def read(self, _re_sanitize=re.compile('\s+|-')):
+	def read(self):
 		# Cron
 		if self.log_tailer:
+			ts_last = ts_last_val = None
 			for line in iter(self.log_tailer.next, u''):
 				# log.debug('LINE: {!r}'.format(line))
 				ts, line = line.strip().split(None, 1)
-				ts = calendar.timegm(iso8601.parse_date(ts).utctimetuple())
-				matched = False
-				for ev, regex in self.lines.viewitems():
-					if not regex: continue
-					match = regex.search(line)
-					if match:
-						matched = True
-						job = match.group('job')
-						for alias, regex in self.aliases:
-							group = alias[1:] if alias.startswith('_') else None
-							alias_match = regex.search(job)
-							if alias_match:
-								if group is not None:
-									job = _re_sanitize.sub('_', alias_match.group(group))
-								else: job = alias
-								break
-						else:
-							log.warn('No alias for cron job: {!r}, skipping'.format(line))
-							continue
-						try: value = float(match.group('val'))
-						except IndexError: value = 1
-						# log.debug('TS: {}, EV: {}, JOB: {}'.format(ts, ev, job))
-						yield Datapoint('cron.tasks.{}.{}'.format(job, ev), 'gauge', value, ts)
-				if not matched:
+				if ts != ts_last: # consecutive lines tend to have same timestamp
+					ts_last, ts_last_val = ts, calendar.timegm(iso8601.parse_date(ts).utctimetuple())
+				ts = ts_last_val
+				matches = self.lines_match(line)
+				for ev, job, value in matches:
+					job = self.alias(job)
+					if job is None:
+						log.warn('No alias for cron job: {!r}, skipping'.format(line))
+						continue
+					# log.debug('TS: {}, EV: {}, JOB: {}'.format(ts, ev, job))
+					yield Datapoint('cron.tasks.{}.{}'.format(job, ev), 'gauge', value, ts)
+				if not matches:
 					log.debug('Failed to match line: {!r}'.format(line))
 
 
@@ -3,8 +3,9 @@
 import itertools as it, operator as op, functools as ft
 from subprocess import Popen, PIPE
 from collections import namedtuple, defaultdict
+from zlib import crc32
 from io import open
-import os, errno
+import os, re, errno
 
 from . import Collector, Datapoint
 
@@ -62,70 +63,97 @@ class IPTables(Collector):
 		return rule_metrics
 
 
-	_table_hash = dict()
+	# Checksums of table contents (keyed by table name) and
+	#  of each rule with metric attached (keyed by table, chain, rule_no),
+	#  and {table: [(line_no, metric, rule_key, rule_sum), ...]} index of rules with metrics
+	_table_sums = dict()
+	_dump_counters = re.compile(r'\[\d+:\d+\]')
+
+	def _dump_tables(self, v, tables):
+		'''Returns {table: [line, ...]} for specified tables
+			and their checksums (with counters stripped), from a single iptables-save run.'''
+		proc = Popen([self.iptables[v], '-c'], stdout=PIPE)
+		dump = proc.communicate()[0]
+		dumps, sums = dict(), dict()
+		for block in ('\n' + dump).split('\n*')[1:]: # "*table" ... "COMMIT"
+			table, block = block.split('\n', 1)
+			table = table.strip()
+			if table not in tables: continue
+			block = block[:block.rfind('\nCOMMIT')]
+			dumps[table] = block.split('\n')
+			sums[table] = crc32(self._dump_counters.sub('', block))
+		return dumps, sums
 
 	def read(self):
 		metric_counts = dict()
-		hashes = defaultdict(lambda: defaultdict(list))
+
+		def add_counts(metric, line):
+			n = line.find(' ') + 1 # "[pkt:bytes] -A chain rule..."
+			counts = map(int, line[1:n-2].split(':', 1))
+			try:
+				metric_counts[metric] = list(it.starmap(
+					op.add, it.izip(metric_counts[metric], counts) ))
+			except KeyError: metric_counts[metric] = counts
 
 		for v, metrics in self.rule_metrics.viewitems():
 			if not metrics: continue
 
 			# Used to detect rule changes
 			try:
-				hash_old, metrics_old, warnings = self._table_hash[v]
+				sums_old, metrics_old, warnings, index_old = self._table_sums[v]
 				if metrics is not metrics_old: raise KeyError
-			except KeyError: hash_old, warnings = None, dict()
-			hash_new = hashes[v]
-
-			# iptables-save invocation and output processing loop
-			proc = Popen([self.iptables[v], '-c'], stdout=PIPE)
-			chain_counts = defaultdict(int)
-			for line in it.imap(op.methodcaller('strip'), proc.stdout):
-				if line[0] != '[': # chain/table spec or comment
-					if line[0] == '*': table = line[1:]
+			except KeyError: sums_old, warnings, index_old = None, dict(), dict()
+			sums_new, index_new = dict(), dict()
+
+			# Only tables with metrics attached are checked, all from one dump
+			dumps, table_sums = self._dump_tables(v, set(it.imap(op.itemgetter(0), metrics.table)))
+			for table, lines in sorted(dumps.viewitems()):
+				table_sum = sums_new[table] = table_sums[table]
+
+				if sums_old and sums_old.get(table) == table_sum and table in index_old:
+					# Same rules as before, only counters for known lines have to be parsed
+					index = index_new[table] = index_old[table]
+					for line_no, metric, rule_key, rule_sum in index:
+						sums_new[rule_key] = rule_sum
+						add_counts(metric, lines[line_no])
 					continue
-				counts, append, chain, rule = line.split(None, 3)
-				assert append == '-A'
-
-				rule_key = table, chain
-				chain_counts[rule_key] += 1 # iptables rules are 1-indexed
-				chain_count = chain_counts[rule_key]
-				# log.debug('{}, Rule: {}'.format([table, chain, chain_count], rule))
-				hash_new[rule_key].append(rule) # but py lists are 0-indexed
-				try: metric = metrics.table[table, chain, chain_count]
-				except KeyError: continue # no point checking rules w/o metrics attached
-				# log.debug('Metric: {} ({}), rule: {}'.format(
-				# 	metric, [table, chain, chain_count], rule ))
-
-				# Check for changed rules
-				try: rule_chk = hash_old and hash_old[rule_key][chain_count - 1]
-				except (KeyError, IndexError): rule_chk = None
-				if hash_old and rule_chk != rule:
-					if chain_count not in warnings:
-						log.warn(
-							( 'Detected changed netfilter rule (chain: {}, pos: {})'
-								' without corresponding rule_metrics file update: {}' )\
-							.format(chain, chain_count, rule) )
-						warnings[chain_count] = True
-					if self.conf.discard_changed_rules: continue
-
-				counts = map(int, counts.strip('[]').split(':', 1))
-				try:
-					metric_counts[metric] = list(it.starmap(
-						op.add, it.izip(metric_counts[metric], counts) ))
-				except KeyError: metric_counts[metric] = counts
-			proc.wait()
-
-			# Detect if there are any changes in the table,
+
+				# Full rule parsing loop
+				chain_counts, index = defaultdict(int), list()
+				index_new[table] = index
+				for line_no, line in enumerate(lines):
+					if line[:1] != '[': continue # chain spec or comment
+					n = line.find(' ') + 1
+					rule = line[n:].rstrip()
+					chain = rule[3:].split(' ', 1)[0]
+
+					rule_key = table, chain
+					chain_counts[rule_key] += 1 # iptables rules are 1-indexed
+					chain_count = chain_counts[rule_key]
+					try: metric = metrics.table[table, chain, chain_count]
+					except KeyError: continue # no point checking rules w/o metrics attached
+
+					# Check for changed rules
+					rule_key = table, chain, chain_count
+					rule_sum = sums_new[rule_key] = crc32(rule)
+					index.append((line_no, metric, rule_key, rule_sum))
+					if sums_old and sums_old.get(rule_key) != rule_sum:
+						if chain_count not in warnings:
+							log.warn(
+								( 'Detected changed netfilter rule (chain: {}, pos: {})'
+									' without corresponding rule_metrics file update: {}' )\
+								.format(chain, chain_count, rule) )
+							warnings[chain_count] = True
+						if self.conf.discard_changed_rules: continue
+
+					add_counts(metric, line)
+
+			# Detect if there are any changes in the tables,
 			#  possibly messing the metrics, even if corresponding rules are the same
-			hash_new = dict( (rule_key, tuple(rules))
-				for rule_key, rules in hash_new.viewitems() )
-			if hash_old\
-					and frozenset(hash_old.viewitems()) != frozenset(hash_new.viewitems()):
+			if sums_old and sums_old != sums_new:
 				log.warn('Detected iptables changes without changes to rule_metrics file')
-				hash_old = None
-			if not hash_old: self._table_hash[v] = hash_new, metrics, dict()
+				sums_old = None
+			if not sums_old: self._table_sums[v] = sums_new, metrics, dict(), index_new
 
 		# Dispatch collected metrics
 		for metric, counts in metric_counts.viewitems():
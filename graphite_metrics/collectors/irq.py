@@ -1,9 +1,11 @@
 # -*- coding: utf-8 -*-
 
 import itertools as it, operator as op, functools as ft
+from array import array
+from time import time
 from io import open
 
-from . import Collector, Datapoint
+from . import Collector, DatapointBatch, counter_rates
 
 import logging
 log = logging.getLogger(__name__)
@@ -11,34 +13,74 @@ log = logging.getLogger(__name__)
 
 class IRQ(Collector):
 
+	'''Counters for each irq and cpu from /proc/interrupts and /proc/softirqs.
+		Each table is parsed into a flat array of values, and metric names
+			for these are only re-generated when set of irqs or cpus changes.
+		With skip_unchanged enabled, rates are calculated here, as difference
+			between these arrays over the poll interval, and only non-zero ones
+			are reported (as gauges), otherwise all counters are passed on as-is,
+			except for rows with only zero counts.
+		These counters are 32-bit (unsigned int in kernel), so negative deltas are always
+			treated as wraparound, both here and in CounterRates (via declared width).
+		Rates calculated here are not persisted, so nothing is reported
+			on the first cycle after restart with skip_unchanged enabled.'''
+
+	tables = ['/proc/interrupts', '/proc/softirqs']
+
+	def __init__(self, *argz, **kwz):
+		super(IRQ, self).__init__(*argz, **kwz)
+		self.state = dict() # path -> (layout, names, rows, values, ts)
+
 	@staticmethod
-	def _parse_irq_table(table):
-		irqs = dict()
-		bindings = map(bytes.lower, table.readline().strip().split())
-		bindings_cnt = len(bindings)
-		for line in it.imap(bytes.strip, table):
+	def _parse_irq_table(data):
+		'Returns cpu names, list of (irq, value_count) and all values as a flat array.'
+		lines = data.splitlines()
+		bindings = map(bytes.lower, lines[0].split())
+		bindings_cnt, irqs, irqs_seen, values = len(bindings), list(), set(), list()
+		for line in it.ifilter(None, it.imap(bytes.strip, it.islice(lines, 1, None))):
 			irq, line = line.split(None, 1)
 			irq = irq.rstrip(':').lower()
-			if irq in irqs:
+			if irq in irqs_seen:
 				log.warn('Conflicting irq name/id: {!r}, skipping'.format(irq))
 				continue
-			irqs[irq] = map(int, line.split(None, bindings_cnt)[:bindings_cnt])
-		return bindings, irqs
-
-	def read(self):
-		irq_tables = list()
-		# /proc/interrupts
-		with open('/proc/interrupts', 'rb') as table:
-			irq_tables.append(self._parse_irq_table(table))
-		# /proc/softirqs
-		with open('/proc/softirqs', 'rb') as table:
-			irq_tables.append(self._parse_irq_table(table))
-		# dispatch
-		for bindings, irqs in irq_tables:
-			for irq, counts in irqs.viewitems():
-				if sum(counts) == 0: continue
-				for bind, count in it.izip(bindings, counts):
-					yield Datapoint('irq.{}.{}'.format(irq, bind), 'counter', count, None)
+			irqs_seen.add(irq)
+			counts = line.split(None, bindings_cnt)[:bindings_cnt]
+			irqs.append((irq, len(counts)))
+			values.extend(counts)
+		return bindings, irqs, array('d', map(float, values))
+
+	def read_batch(self):
+		batch = DatapointBatch()
+		for path in self.tables:
+			with open(path, 'rb') as table: data, ts = table.read(), time()
+			bindings, irqs, values = self._parse_irq_table(data)
+			layout = bindings, irqs
+			try: layout_old, names, rows, values_old, ts_old = self.state[path]
+			except KeyError: layout_old = None
+			if layout != layout_old:
+				names, rows, n = list(), list(), 0
+				for irq, count in irqs:
+					names.extend(it.imap('irq.{}.{}'.format, it.repeat(irq), bindings[:count]))
+					rows.append((n, n + count))
+					n += count
+				counter_rates.set_bits(names, 32) # unsigned int in kernel
+				values_old = None
+			self.state[path] = layout, names, rows, values, ts
+
+			if self.conf.skip_unchanged:
+				if values_old is None or ts <= ts_old: continue # no rates until next poll
+				deltas = map( op.mod, # negative delta - 32-bit wraparound
+					map(op.sub, values, values_old), it.repeat(2**32, len(values)) )
+				mask = map(ft.partial(op.lt, 0), deltas)
+				batch.extend_values( it.compress(names, mask), 'gauge',
+					it.imap(op.truediv, it.compress(deltas, mask), it.repeat(ts - ts_old)) )
+			else:
+				mask = list()
+				for n0, n1 in rows: mask.extend(it.repeat(any(values[n0:n1]), n1 - n0))
+				batch.extend_values(it.compress(names, mask), 'counter', it.compress(values, mask))
+		return batch
+
+	def read(self): return iter(self.read_batch())
 
 
 collector = IRQ
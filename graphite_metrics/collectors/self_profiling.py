@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+
+import itertools as it, operator as op, functools as ft
+from io import open
+
+from graphite_metrics import loops
+from . import Collector, Datapoint, page_size
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class SelfProfiling(Collector):
+
+	'''Reports wall/cpu time spent by harvestd in each collector, processor and sink,
+			number of datapoints passed through these, main loop lag and daemon RSS.
+		All values are sums since the previous poll of this collector,
+			so processor/sink stats are from the previous loop cycle.'''
+
+	def __init__(self, *argz, **kwz):
+		super(SelfProfiling, self).__init__(*argz, **kwz)
+		if not (self.conf.main_loop or self.conf.collectors):
+			log.info('Neither main_loop nor collectors stats are enabled, disabling collector')
+			self.conf.enabled = False
+			return
+		loops.profiler = self.profiler = loops.Profiler()
+
+	def read(self):
+		stats, lag = self.profiler.pop()
+		for (stage, name), (wall, cpu, count) in stats.viewitems():
+			if not (self.conf.collectors if stage == 'collectors' else self.conf.main_loop): continue
+			for metric, val in [('time_wall', wall), ('time_cpu', cpu), ('datapoints', count)]:
+				yield Datapoint( 'harvestd.{}.{}.{}'\
+					.format(stage, name, metric), 'gauge', val, None )
+		if self.conf.main_loop:
+			if lag is not None: yield Datapoint('harvestd.loop.lag', 'gauge', lag, None)
+			with open('/proc/self/statm', 'rb') as src: rss = int(src.read().split()[1])
+			yield Datapoint('harvestd.memory.rss', 'gauge', rss * page_size, None)
+
+
+collector = SelfProfiling
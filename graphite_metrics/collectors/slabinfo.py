@@ -4,7 +4,7 @@ import itertools as it, operator as op, functools as ft
 from collections import namedtuple
 from io import open
 
-from . import Collector, Datapoint, page_size
+from . import Collector, DatapointBatch, page_size
 
 import logging
 log = logging.getLogger(__name__)
@@ -42,8 +42,8 @@ class SlabInfo(Collector):
 					for idx,val in enumerate(picker(line.strip().split())) ))
 
 	# http://elinux.org/Slab_allocator
-	def read(self):
-		parse_line, ps = self.parse_line, page_size
+	def read_batch(self):
+		batch, parse_line, ps = DatapointBatch(), self.parse_line, page_size
 		with open('/proc/slabinfo', 'rb') as table:
 			table.readline(), table.readline() # header
 			for line in table:
@@ -62,8 +62,11 @@ class SlabInfo(Collector):
 						('slab_allocated', info.num_slabs * info.pagesperslab * ps) ]
 					if self.conf.pass_zeroes or sum(it.imap(op.itemgetter(1), vals)) != 0:
 						for val_name, val in vals:
-							yield Datapoint( 'memory.slabs.{}.bytes_{}'\
-								.format(info.name, val_name), 'gauge', val, None )
+							batch.append( 'memory.slabs.{}.bytes_{}'\
+								.format(info.name, val_name), 'gauge', val )
+		return batch
+
+	def read(self): return iter(self.read_batch())
 
 
 collector = SlabInfo
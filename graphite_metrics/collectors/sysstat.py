@@ -2,23 +2,63 @@
 
 import itertools as it, operator as op, functools as ft
 from subprocess import Popen, PIPE, STDOUT
+from collections import namedtuple
 from time import time, sleep, strptime, mktime
 from calendar import timegm
 from datetime import datetime, timedelta
 from xattr import xattr
-import os, sys, socket, struct
+import os, sys, re, socket, struct
 
-from . import Collector, Datapoint, dev_resolve, sector_bytes, rate_limit
+from . import Collector, Datapoint, RunSchedule, dev_resolve, sector_bytes
+from ._safile import SAFile, SAFormatError
 
-try: from simplejson import loads, dumps, JSONDecodeError
+try: from simplejson import dumps, JSONDecoder, JSONDecodeError
 except ImportError:
-	from json import loads, dumps
+	from json import dumps, JSONDecoder
 	JSONDecodeError = ValueError
 
 import logging
 log = logging.getLogger(__name__)
 
 
+def sadf_stream( src, bs=2**16, tail=256,
+		_re_stats=re.compile(r'"statistics"\s*:\s*\['),
+		_re_nodename=re.compile(r'"nodename"\s*:\s*"([^"]*)"'),
+		_decode=JSONDecoder().raw_decode, _skip=' \t\r\n,' ):
+	'''Incrementally parses "sadf -j" output from file-like src, yielding
+			(nodename, entry) for each element of "statistics" array(s) as soon as it's read.
+		Only one entry (plus read buffer) is held in memory at a time,
+			everything outside of "statistics" except for "nodename" is skipped.'''
+	buff, pos, eof, nodename, in_stats = '', 0, False, None, False
+	while True:
+		if not in_stats:
+			match = _re_stats.search(buff, pos)
+			names = _re_nodename.findall(buff, pos, match.start() if match else len(buff))
+			if names: nodename = names[-1]
+			if match:
+				pos, in_stats = match.end(), True
+				continue
+			pos = max(pos, len(buff) - tail) # in case key/nodename gets split between reads
+		else:
+			while pos < len(buff) and buff[pos] in _skip: pos += 1
+			if pos < len(buff):
+				if buff[pos] == ']':
+					pos, in_stats = pos + 1, False
+					continue
+				try: entry, pos_end = _decode(buff, pos)
+				except ValueError: # incomplete entry or malformed data
+					if eof: raise JSONDecodeError('Failed to decode sadf entry at: {!r}'.format(buff[pos:pos+50]))
+				else:
+					yield nodename, entry
+					pos = pos_end
+					continue
+		if eof: break
+		chunk = src.read(bs)
+		if not chunk: eof = True
+		buff, pos = buff[pos:] + chunk, 0
+	if in_stats: raise JSONDecodeError('Unexpected end of sadf output in "statistics" array')
+
+
 class SADF(Collector):
 
 
@@ -41,10 +81,9 @@ class SADF(Collector):
 				self.force_interval = interval - fuzz, interval + fuzz
 		else: self.force_interval = None
 
-		self.rate_limit = rate_limit(
-				max_interval=self.conf.rate.max_interval,
-				sampling=self.conf.rate.sampling )\
-			if self.conf.rate.limiting_enabled else None
+		sched = self.conf.schedule
+		self.schedule = RunSchedule( sched.interval, interval_min=sched.interval_min,
+			jitter=sched.jitter, backlog_max=sched.backlog_max ) if sched.enabled else None
 
 
 	def process_entry(self, entry):
@@ -56,15 +95,17 @@ class SADF(Collector):
 				' without timestamp, skipping: {!r}'.format(entry) )
 			return # happens, no idea what to do with these
 		interval = ts['interval']
-		for fmt in '%Y-%m-%d %H-%M-%S', '%Y-%m-%d %H:%M:%S':
-			try:
-				ts = (mktime if not ts['utc'] else timegm)\
-					(strptime('{} {}'.format(ts['date'], ts['time']), fmt))
-			except ValueError: pass
-			else: break
+		if 'ts' in ts: ts = ts['ts'] # unix timestamp from SAFile
 		else:
-			raise ValueError( 'Unable to process'
-				' sysstat timestamp: {!r} {!r}'.format(ts['date'], ts['time']) )
+			for fmt in '%Y-%m-%d %H-%M-%S', '%Y-%m-%d %H:%M:%S':
+				try:
+					ts = (mktime if not ts['utc'] else timegm)\
+						(strptime('{} {}'.format(ts['date'], ts['time']), fmt))
+				except ValueError: pass
+				else: break
+			else:
+				raise ValueError( 'Unable to process'
+					' sysstat timestamp: {!r} {!r}'.format(ts['date'], ts['time']) )
 
 		# Metrics
 		metrics = list()
@@ -145,103 +186,169 @@ class SADF(Collector):
 		return ts, interval, metrics
 
 
-	def _read(self, ts_to=None, max_past_days=7):
+	_sa_job = namedtuple('SAJob', 'path day xattr ts_from ts_start stat pos')
+	_sa_pos = struct.Struct('=IQIQ') # ts, file size, mtime, offset of the last record
+	_sa_pos_v1 = struct.Struct('=IQI') # without record offset
+
+	def _sa_pos_get(self, sa_xattr):
+		'Returns (ts, (size, mtime), offset) from file xattr, with zeroes for missing values.'
+		try: pos = sa_xattr[self.conf.xattr_name]
+		except KeyError: return 0, (0, 0), 0
+		if len(pos) == 4: return struct.unpack('=I', pos)[0], (0, 0), 0 # older formats
+		if len(pos) == self._sa_pos_v1.size: pos = self._sa_pos_v1.unpack(pos) + (0,)
+		else: pos = self._sa_pos.unpack(pos)
+		return pos[0], pos[1:3], pos[3]
+
+	def _sa_pos_set(self, sa_xattr, ts, stat, offset=0):
+		log.debug('Updating xattr timestamp to {} (size/mtime: {}, offset: {})'.format(ts, stat, offset))
+		if not self.conf.debug.dry_run:
+			sa_xattr[self.conf.xattr_name] = self._sa_pos.pack(int(ts), stat[0], stat[1], offset)
+
+	def _sa_jobs(self, ts_to=None, max_past_days=7):
+		'Yields SAJob tuples for sa files that have to be processed, in order.'
 		if not ts_to: ts_to = datetime.now()
 
 		sa_days = dict( (ts.day, ts) for ts in
 			((ts_to - timedelta(i)) for i in xrange(max_past_days+1)) )
 		sa_files = sorted(it.ifilter(
 			op.methodcaller('startswith', 'sa'), os.listdir(self.conf.sa_path) ))
-		host = os.uname()[1] # to check vs nodename in data
 		log.debug('SA files to process: {}'.format(sa_files))
 
 		for sa in sa_files:
 			sa_day = int(sa[2:])
 			try: sa_day = sa_days[sa_day]
 			except KeyError: continue # too old or new
-			sa_ts_to = None # otherwise it's possible to get data for the oldest day in a file
 
 			sa = os.path.join(self.conf.sa_path, sa)
 			log.debug('Processing file: {}'.format(sa))
 
-			# Read xattr timestamp
+			# Read xattr timestamp and size/mtime of the file at that point,
+			#  so that file won't have to be read if there's no new data in it
 			sa_xattr = xattr(sa)
-			try: sa_ts_from = sa_xattr[self.conf.xattr_name]
-			except KeyError: sa_ts_from = None
+			sa_ts_pos, sa_stat_pos, sa_offset = self._sa_pos_get(sa_xattr)
+			sa_stat = os.stat(sa)
+			sa_stat = sa_stat.st_size, int(sa_stat.st_mtime)
+			if sa_stat == sa_stat_pos:
+				log.debug('No changes in file since last check, skipping: {}'.format(sa))
+				continue
+			sa_ts_from = sa_ts_pos and datetime.fromtimestamp(sa_ts_pos)
 			if sa_ts_from:
-				sa_ts_from = datetime.fromtimestamp(
-					struct.unpack('=I', sa_ts_from)[0] )
 				if sa_day - sa_ts_from > timedelta(1) + timedelta(seconds=60):
 					log.debug( 'Discarding xattr timestamp, because'
 						' it doesnt seem to belong to the same date as file'
 						' (day: {}, xattr: {})'.format(sa_day, sa_ts_from) )
-					sa_ts_from = None
+					sa_ts_from = sa_offset = None
 				if sa_ts_from and sa_ts_from.date() != sa_day.date():
 					log.debug('File xattr timestamp points to the next day, skipping file')
 					continue
 
-			# Get data from sadf
-			sa_cmd = ['sadf', '-jt']
-			if sa_ts_from: sa_cmd.extend(['-s', sa_ts_from.strftime('%H:%M:%S')])
-			if sa_ts_to: sa_cmd.extend(['-e', sa_ts_to.strftime('%H:%M:%S')])
-			sa_cmd.extend(['--', '-A'])
-			sa_cmd.append(sa)
-			log.debug('sadf command: {}'.format(sa_cmd))
-			sa_proc = Popen(sa_cmd, stdout=PIPE)
-			try: data = loads(sa_proc.stdout.read())
+			yield self._sa_job( sa, sa_day, sa_xattr,
+				sa_ts_pos, sa_ts_from and sa_ts_pos, sa_stat, sa_offset )
+
+	def _sadf_cmd(self, sa, ts_from=None):
+		sa_cmd = ['sadf', '-jt']
+		if ts_from: sa_cmd.extend(['-s', datetime.fromtimestamp(ts_from).strftime('%H:%M:%S')])
+		sa_cmd.extend(['--', '-A', sa])
+		return sa_cmd
+
+	def _backlog(self, jobs):
+		'Returns number of seconds of sa data that was not processed yet.'
+		if not jobs: return 0
+		ts_from = min(job.ts_from or mktime(job.day.date().timetuple()) for job in jobs)
+		return max(0, time() - ts_from)
+
+	def _sa_datapoints(self, job, entries, state, host=os.uname()[1]):
+		'''Yields datapoints from (nodename, entry) tuples for sa file,
+			as produced by sadf_stream() or SAFile.entries(), updating state["ts_max"].'''
+		sa, sa_day_ts, nodename_warn = job.path, mktime(job.day.timetuple()), None
+		for nodename, entry in entries:
+			if nodename != host:
+				if nodename_warn != nodename:
+					log.warn( 'Mismatching hostname in sa data:'
+						' {} (uname: {}), skipping'.format(nodename, host) )
+					nodename_warn = nodename
+				continue
+			entry = self.process_entry(entry)
+			if not entry: continue
+			ts, interval, metrics = entry
+			if ts - 1 > state['ts_max']:
+				# has to be *before* beginning of the next interval
+				state['ts_max'] = ts - 1
+			if abs(ts - sa_day_ts) > 24*3600 + interval + 1:
+				log.warn( 'Dropping sample because of timestamp mismatch'
+					' (timestamp: {}, expected date: {})'.format(ts, sa_day_ts) )
+				continue
+			if self.force_interval and (
+					interval < self.force_interval[0]
+					or interval > self.force_interval[1] ):
+				log.warn( 'Dropping sample because of interval mismatch'
+					' (file: {sa}, interval: {interval},'
+					' required: {margins[0]}-{margins[1]}, timestamp: {ts})'\
+						.format(sa=sa, interval=interval, ts=ts, margins=self.force_interval) )
+				continue
+			ts_val = int(ts)
+			for name, val in metrics:
+				yield Datapoint('.'.join(name), 'gauge', val, ts_val)
+
+	def _read_native(self, job, state):
+		'''Yields datapoints from sa file, read in-process, if its format is supported.
+			Sets state["pos"] to offset of the last record, to continue from there next time,
+				or leaves it unset if sadf has to be used for the rest of the file.'''
+		try: sa_file = SAFile(job.path)
+		except (OSError, IOError, ValueError, SAFormatError) as err:
+			log.debug('Unable to read sa file in-process ({}), using sadf: {}'.format(job.path, err))
+			return
+		with sa_file:
+			entries = sa_file.entries(job.pos, job.ts_start and job.ts_start + 1)
+			try:
+				for dp in self._sa_datapoints(job, entries, state): yield dp
+			except SAFormatError as err:
+				log.warn(( 'Failed to read sa file in-process ({}),'
+					' using sadf for the rest of it: {}' ).format(job.path, err))
+			else: state['pos'] = sa_file.pos or 0
+
+	def _read_sadf(self, job, state):
+		ts_from = max(state['ts_max'], job.ts_start)
+		sa_cmd = self._sadf_cmd(job.path, ts_from)
+		log.debug('sadf command: {}'.format(sa_cmd))
+		sa_proc = Popen(sa_cmd, stdout=PIPE, close_fds=True)
+		try:
+			try:
+				for dp in self._sa_datapoints(job, sadf_stream(sa_proc.stdout), state): yield dp
 			except JSONDecodeError as err:
 				log.exception(( 'Failed to process sadf (file:'
-					' {}, command: {}) output: {}' ).format(sa, sa_cmd, err))
-				data = None
+					' {}, command: {}) output: {}' ).format(job.path, sa_cmd, err))
+				sa_proc.kill()
+				state['stat'] = 0, 0 # file will be re-checked on next run
 			if sa_proc.wait():
 				log.error('sadf (command: {}) exited with error'.format(sa_cmd))
-				data = None
-			if not data:
-				log.warn('Skipping processing of sa file: {}'.format(sa))
-				continue
-
-			# Process and dispatch the datapoints
-			sa_ts_max = 0
-			for data in data['sysstat']['hosts']:
-				if data['nodename'] != host:
-					log.warn( 'Mismatching hostname in sa data:'
-						' {} (uname: {}), skipping'.format(data['nodename'], host) )
-					continue
-				sa_day_ts = mktime(sa_day.timetuple())
-				# Read the data
-				for ts, interval, metrics in it.ifilter(
-						None, it.imap(self.process_entry, data['statistics']) ):
-					if ts - 1 > sa_ts_max:
-						# has to be *before* beginning of the next interval
-						sa_ts_max = ts - 1
-					if abs(ts - sa_day_ts) > 24*3600 + interval + 1:
-						log.warn( 'Dropping sample because of timestamp mismatch'
-							' (timestamp: {}, expected date: {})'.format(ts, sa_day_ts) )
-						continue
-					if self.force_interval and (
-							interval < self.force_interval[0]
-							or interval > self.force_interval[1] ):
-						log.warn( 'Dropping sample because of interval mismatch'
-							' (file: {sa}, interval: {interval},'
-							' required: {margins[0]}-{margins[1]}, timestamp: {ts})'\
-								.format(sa=sa, interval=interval, ts=ts, margins=self.force_interval) )
-						continue
-					ts_val = int(ts)
-					for name, val in metrics:
-						yield Datapoint('.'.join(name), 'gauge', val, ts_val)
-
-			# Update xattr timestamp, if any entries were processed
-			if sa_ts_max:
-				log.debug('Updating xattr timestamp to {}'.format(sa_ts_max))
-				if not self.conf.debug.dry_run:
-					sa_xattr[self.conf.xattr_name] = struct.pack('=I', int(sa_ts_max))
+				state['stat'] = 0, 0
+		finally:
+			if sa_proc.poll() is None: sa_proc.kill() # generator was closed early
+			sa_proc.wait()
+
+	def _read(self, jobs=None, ts_to=None, max_past_days=7):
+		# Files are read in-process (see SAFile), if enabled and format is supported,
+		#  otherwise sadf is started for each one in turn, with output processed incrementally
+		if jobs is None: jobs = self._sa_jobs(ts_to, max_past_days)
+		for job in jobs:
+			state = dict(ts_max=0, stat=job.stat, pos=None)
+			if self.conf.native_reader:
+				for dp in self._read_native(job, state): yield dp
+			if state['pos'] is None:
+				for dp in self._read_sadf(job, state): yield dp
+			# Update xattr timestamp and file size/mtime/offset it corresponds to
+			self._sa_pos_set( job.xattr,
+				max(state['ts_max'], job.ts_from), state['stat'], state['pos'] or 0 )
 
 
 	def read(self):
-		if not self.rate_limit or next(self.rate_limit):
-			log.debug('Running sysstat data processing cycle')
-			return self._read()
-		else: return list()
+		# Checking for new data only needs listdir/stat/getxattr, so is done on every call
+		jobs = list(self._sa_jobs())
+		if not jobs: return list()
+		if self.schedule and not self.schedule.due(self._backlog(jobs)): return list()
+		log.debug('Running sysstat data processing cycle')
+		return self._read(jobs)
 
 
 collector = SADF
@@ -55,7 +55,7 @@ def main():
 	parser.add_argument('-a', '--xattr-emulation', metavar='db-path',
 		help='Emulate filesystem extended attributes (used in'
 			' some collectors like sysstat or cron_log), storing per-path'
-			' data in a simple shelve db.')
+			' data in a simple db file.')
 	parser.add_argument('-n', '--dry-run',
 		action='store_true', help='Do not actually send data.')
 	parser.add_argument('--debug',
@@ -81,9 +81,8 @@ def main():
 	try:
 		if optz.destination: cfg.sinks._default.host = optz.destination
 		cfg.sinks._default.host = cfg.sinks._default.host.rsplit(':', 1)
-		if len(cfg.sinks._default.host) == 1:
-			cfg.sinks._default.host =\
-				cfg.sinks._default.host[0], cfg.sinks._default.default_port
+		if len(cfg.sinks._default.host) == 1: # port is picked by sink, based on protocol
+			cfg.sinks._default.host = cfg.sinks._default.host[0], None
 		else: cfg.sinks._default.host[1] = int(cfg.sinks._default.host[1])
 	except KeyError: pass
 	if optz.interval: cfg.loop.interval = optz.interval
@@ -92,18 +91,9 @@ def main():
 
 	# Fake "xattr" module, if requested
 	if cfg.core.xattr_emulation:
-		import shelve
-		xattr_db = shelve.open(cfg.core.xattr_emulation, 'c')
-		class xattr_path(object):
-			def __init__(self, base):
-				assert isinstance(base, str)
-				self.base = base
-			def key(self, k): return '{}\0{}'.format(self.base, k)
-			def __setitem__(self, k, v): xattr_db[self.key(k)] = v
-			def __getitem__(self, k): return xattr_db[self.key(k)]
-			def __del__(self): xattr_db.sync()
-		class xattr_module(object): xattr = xattr_path
-		sys.modules['xattr'] = xattr_module
+		from graphite_metrics import xattr_emulation
+		xattr_emulation.install( cfg.core.xattr_emulation,
+			flush_interval=cfg.core.get('xattr_emulation_flush_interval', 60) )
 
 	# Override "enabled" collector/sink parameters, based on CLI
 	ep_conf = dict()
@@ -120,6 +110,16 @@ def main():
 	from graphite_metrics import collectors, sinks, loops
 	collectors.cfg = sinks.cfg = loops.cfg = cfg
 
+	# Make sure atexit hooks (e.g. saving counter state) are run on SIGTERM
+	import signal
+	signal.signal(signal.SIGTERM, lambda sig, frm: sys.exit(0))
+
+	# Restore/persist counter values, if requested
+	if cfg.core.counter_state.path:
+		collectors.counter_rates.persist( cfg.core.counter_state.path,
+			interval=cfg.core.counter_state.save_interval,
+			max_age=cfg.core.counter_state.max_age )
+
 	# Init pluggable components
 	import pkg_resources
 
@@ -1,7 +1,10 @@
 # -*- coding: utf-8 -*-
 
 import itertools as it, operator as op, functools as ft
+from threading import Lock
+from bisect import bisect_right
 from time import time
+import heapq, resource
 
 import logging
 log = logging.getLogger(__name__)
@@ -11,12 +14,118 @@ log = logging.getLogger(__name__)
 #  but should not be really relied upon - can be empty.
 cfg = dict()
 
+# Profiler object, set by self_profiling collector, if it's enabled.
+profiler = None
+
+
+class Profiler(object):
+
+	'''Accumulates wall/cpu time spent and number of datapoints passed
+			through each loop stage (collectors, processors, sinks), and loop lag.
+		Stats are summed until pop() is called, see self_profiling collector.'''
+
+	rusage_thread = getattr(resource, 'RUSAGE_THREAD', 1) # linux-specific, missing in py2
+
+	def __init__(self):
+		self.lock, self.stats, self.lag = Lock(), dict(), None
+
+	def cpu_time(self):
+		ru = resource.getrusage(self.rusage_thread)
+		return ru.ru_utime + ru.ru_stime
+
+	def call(self, stage, name, count, func, *argz):
+		'''Returns func(*argz), recording time it took and count
+			of datapoints (len() of the result, if None) for stage/name.'''
+		ts, cpu = time(), self.cpu_time()
+		res = func(*argz)
+		wall, cpu = time() - ts, self.cpu_time() - cpu
+		if count is None: count = len(res)
+		with self.lock:
+			try: stats = self.stats[stage, name]
+			except KeyError: stats = self.stats[stage, name] = [0, 0, 0]
+			stats[0] += wall
+			stats[1] += cpu
+			stats[2] += count
+		return res
+
+	def pop(self):
+		'Returns and resets accumulated {(stage, name): [wall, cpu, count]} stats and loop lag.'
+		with self.lock:
+			stats, lag, self.stats, self.lag = self.stats, self.lag, dict(), None
+		return stats, lag
+
+
+class Backfill(object):
+
+	'''Per-sink queues for datapoints with timestamps older than "age" seconds
+			(e.g. from sysstat or cron_log catching up after downtime).
+		Queued datapoints are sent in time order after live ones on each dispatch,
+			at an average rate of up to "rate" datapoints per second,
+			with no more than rate * burst (seconds) of these sent at once.
+		Oldest datapoints are dropped if queue grows larger than queue_max.
+		Queues are only kept in memory, so whatever is left there is lost on restart.'''
+
+	def __init__(self, age, rate, burst, queue_max=None, time_func=time):
+		self.age, self.rate, self.burst = age, rate, burst
+		self.queue_max, self.time_func = queue_max, time_func
+		self.queues, self.budgets = dict(), dict() # sink name -> batch, (count, ts)
+
+	def queue(self, name, batch):
+		'Moves historical datapoints from a batch to a queue, returning batch of live ones.'
+		ts_min = self.time_func() - self.age
+		if not batch or min(batch.ts) >= ts_min: return batch
+		old = list(it.imap(op.lt, batch.ts, it.repeat(ts_min)))
+		batch, old = batch.select(map(op.not_, old)), batch.select(old)
+		old = old.take(sorted(xrange(len(old)), key=old.ts.__getitem__))
+		queue = self.queues.get(name)
+		if not queue: queue = old
+		elif old.ts[0] >= queue.ts[-1]: queue.extend(old)
+		else: # merge sorted chunk into overlapping tail of the queue
+			n = bisect_right(queue.ts, old.ts[0])
+			tail, queue = queue.slice(n), queue.slice(0, n)
+			k = len(tail)
+			tail.extend(old)
+			queue.extend(tail.take(it.imap(op.itemgetter(1), heapq.merge(
+				it.izip(tail.ts[:k], xrange(k)), it.izip(old.ts, it.count(k)) ))))
+		self.queues[name] = queue
+		if self.queue_max and len(queue) > self.queue_max:
+			drop = len(queue) - self.queue_max
+			log.warn(( 'Backfill queue for sink {!r} is full,'
+				' dropping {} oldest datapoint(s)' ).format(name, drop))
+			queue = self.queues[name] = queue.slice(drop)
+		log.debug('Backfill queue for sink {!r}: {} datapoint(s)'.format(name, len(queue)))
+		return batch
+
+	def get(self, name):
+		'Returns next time-ordered chunk of queued datapoints, which is allowed to be sent now.'
+		queue = self.queues.get(name)
+		if not queue: return None
+		ts, count_max = self.time_func(), self.rate * self.burst
+		count, ts0 = self.budgets.get(name, (count_max, ts))
+		count = min(count_max, count + (ts - ts0) * self.rate)
+		chunk, n = None, min(len(queue), int(count))
+		if n:
+			chunk, queue = queue.slice(0, n), queue.slice(n)
+			if queue: self.queues[name] = queue
+			else: del self.queues[name]
+		self.budgets[name] = count - n, ts
+		return chunk
+
 
 class Loop(object):
 
 	def __init__(self, conf, time_func=time):
 		self.conf, self.time_func = conf, time_func
 
+	def call(self, stage, name, count, func, *argz):
+		'Returns func(*argz), recording stats for it via profiler, if one is enabled.'
+		if not profiler: return func(*argz)
+		return profiler.call(stage, name, count, func, *argz)
+
+	def lag(self, ts):
+		'Records delay of the current time from the scheduled one, if profiler is enabled.'
+		if profiler: profiler.lag = max(profiler.lag, self.time_func() - ts, 0)
+
 	def start(self, collectors, processors, sinks):
 		raise NotImplementedError( 'Loop.start method should be'
 			' overidden in loop subclasses to start poll/process/send loop'
@@ -2,7 +2,8 @@
 
 import itertools as it, operator as op, functools as ft
 
-from . import Loop
+from graphite_metrics.collectors import DatapointBatch
+from . import Loop, Backfill
 
 import logging
 log = logging.getLogger(__name__)
@@ -12,47 +13,78 @@ class BasicLoop(Loop):
 
 	'Simple synchronous "while True: fetch && process && send" loop.'
 
+	def __init__(self, *argz, **kwz):
+		super(BasicLoop, self).__init__(*argz, **kwz)
+		conf = self.conf.get('backfill')
+		self.backfill = Backfill( conf.age, conf.rate,
+				conf.burst or self.conf.interval, conf.queue_max, time_func=self.time_func )\
+			if conf and conf.enabled else None
+
+	def poll(self, collectors):
+		data = DatapointBatch()
+		for name, collector in collectors.viewitems():
+			log.debug('Polling data from a collector (name: {}): {}'.format(name, collector))
+			try: data.extend(self.call('collectors', name, None, collector.read_batch))
+			except Exception as err:
+				log.exception( 'Failed to poll collector'
+					' (name: {}, obj: {}): {}'.format(name, collector, err) )
+		return data
+
+	@staticmethod
+	def chain(processors):
+		'Returns processor chain, to be built once and passed to process().'
+		return list((name, proc, proc.process_batch) for name, proc in processors.viewitems())
+
+	def process(self, data, chain, sinks, ts_now):
+		data = data.get(ts=ts_now)
+		log.debug('Processing {} datapoints'.format(len(data)))
+		routes = dict.fromkeys(sinks) # sink name -> row mask, None for all rows
+		for name, proc, process_batch in chain:
+			try: data, routes = self.call( 'processors',
+				name, len(data), process_batch, data, routes, sinks )
+			except Exception as err:
+				log.exception(( 'Failed to process datapoints (processor: {}, obj: {}):'
+					' {}, discarding {} datapoints' ).format(name, proc, err, len(data)))
+				return dict()
+		sink_data = dict() # to batch datapoints on per-sink basis
+		for name, mask in routes.viewitems():
+			batch = data if mask is None else data.select(mask)
+			if batch: sink_data[name] = batch
+		return sink_data
+
+	def dispatch(self, sink_data, sinks):
+		log.debug('Dispatching data to {} sink(s)'.format(len(sink_data)))
+		if self.conf.debug.dry_run: return
+		if self.backfill:
+			sink_data = dict(sink_data)
+			for name in set(sink_data).union(it.ifilter(sinks.has_key, self.backfill.queues)):
+				batch = self.backfill.queue(name, sink_data.get(name))
+				chunk = self.backfill.get(name)
+				if chunk: # sent after live datapoints
+					if not batch: batch = chunk
+					else:
+						batch = DatapointBatch(batch)
+						batch.extend(chunk)
+				if batch: sink_data[name] = batch
+				else: sink_data.pop(name, None)
+		for name, batch in sink_data.viewitems():
+			sink = sinks[name]
+			log.debug(( 'Sending {} datapoints to sink'
+				' (name: {}): {}' ).format(len(batch), name, sink))
+			try: self.call('sinks', name, len(batch), sink.dispatch_batch, batch)
+			except Exception as err:
+				log.exception( 'Failed to dispatch data to sink'
+					' (name: {}, obj: {}): {}'.format(name, sink, err) )
+
 	def start(self, collectors, processors, sinks):
-		from time import time, sleep
+		from time import sleep
 
-		ts = self.time_func()
+		chain, ts = self.chain(processors), self.time_func()
 		while True:
-			data = list()
-			for name, collector in collectors.viewitems():
-				log.debug('Polling data from a collector (name: {}): {}'.format(name, collector))
-				try: data.extend(collector.read())
-				except Exception as err:
-					log.exception( 'Failed to poll collector'
-						' (name: {}, obj: {}): {}'.format(name, collector, err) )
-
+			self.lag(ts)
+			data = self.poll(collectors)
 			ts_now = self.time_func()
-			sink_data = dict() # to batch datapoints on per-sink basis
-
-			log.debug('Processing {} datapoints'.format(len(data)))
-			for dp in it.ifilter(None, (dp.get(ts=ts_now) for dp in data)):
-				proc_sinks = sinks.copy()
-				for name, proc in processors.viewitems():
-					if dp is None: break
-					try: dp, sinks = proc.process(dp, sinks)
-					except Exception as err:
-						log.exception(( 'Failed to process datapoint (data: {},'
-							' processor: {}, obj: {}): {}, discarding' ).format(dp, name, proc, err))
-						break
-				else:
-					if dp is None: continue
-					for name, sink in proc_sinks.viewitems():
-						try: sink_data[name].append(dp)
-						except KeyError: sink_data[name] = [dp]
-
-			log.debug('Dispatching data to {} sink(s)'.format(len(sink_data)))
-			if not self.conf.debug.dry_run:
-				for name, tuples in sink_data.viewitems():
-					log.debug(( 'Sending {} datapoints to sink'
-						' (name: {}): {}' ).format(len(tuples), name, sink))
-					try: sinks[name].dispatch(*tuples)
-					except Exception as err:
-						log.exception( 'Failed to dispatch data to sink'
-							' (name: {}, obj: {}): {}'.format(name, sink, err) )
+			self.dispatch(self.process(data, chain, sinks, ts_now), sinks)
 
 			while ts < ts_now: ts += self.conf.interval
 			ts_sleep = max(0, ts - self.time_func())
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+import itertools as it, operator as op, functools as ft
+from collections import deque
+from time import sleep
+import sched
+
+from graphite_metrics.collectors import DatapointBatch
+from .basic import BasicLoop
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class ScheduledLoop(BasicLoop):
+
+	'''Single event loop, running each collector, datapoint processing
+			and each sink on its own schedule (see "schedules" in loop configuration),
+			with loop "interval" used for anything that doesn't have one set explicitly.
+		Collected data gets timestamped and passed to processors through a non-blocking
+			queue, processed datapoints are buffered per-sink until the next dispatch.'''
+
+	# Priorities for tasks scheduled at the same time
+	prio_collect, prio_process, prio_dispatch = range(3)
+
+	def __init__(self, *argz, **kwz):
+		super(ScheduledLoop, self).__init__(*argz, **kwz)
+		self.schedules = self.conf.get('schedules') or dict()
+		self._check_intervals()
+		self.sched = sched.scheduler(self.time_func, sleep)
+		self.queue, self.buffers = deque(), dict()
+
+	def _check_intervals(self):
+		'Raises ValueError for any non-positive interval, which would make run() loop forever.'
+		intervals = [('interval', self.conf.interval)]
+		for ep_type, interval in self.schedules.viewitems():
+			if isinstance(interval, dict):
+				intervals.extend( ('schedules.{}.{}'.format(ep_type, name), v)
+					for name, v in interval.viewitems() )
+			else: intervals.append(('schedules.{}'.format(ep_type), interval))
+		for name, interval in intervals:
+			if interval is not None and not interval > 0:
+				raise ValueError('Loop interval must be positive: {} = {!r}'.format(name, interval))
+
+	def interval(self, ep_type, name=None):
+		interval = self.schedules.get(ep_type)
+		if name is not None: interval = (interval or dict()).get(name)
+		return interval or self.conf.interval
+
+	def schedule(self, ts, interval, prio, func, *argz):
+		self.sched.enterabs(ts, prio, self.run, (ts, interval, prio, func) + argz)
+
+	def run(self, ts, interval, prio, func, *argz):
+		self.lag(ts)
+		try: func(*argz)
+		except Exception as err:
+			log.exception('Failed to run scheduled task ({}{}): {}'.format(func, argz, err))
+		ts_now = self.time_func()
+		while ts <= ts_now: ts += interval # missed runs are skipped
+		self.schedule(ts, interval, prio, func, *argz)
+
+
+	def collect(self, name, collector):
+		data = self.poll({name: collector})
+		if data: self.queue.append((self.time_func(), data))
+
+	def process_queue(self, chain, sinks):
+		while self.queue:
+			ts, data = self.queue.popleft()
+			for name, dps in self.process(data, chain, sinks, ts).viewitems():
+				try: self.buffers[name].extend(dps)
+				except KeyError: self.buffers[name] = DatapointBatch(dps)
+
+	def flush(self, name, sink):
+		data = self.buffers.pop(name, None)
+		if data or (self.backfill and name in self.backfill.queues):
+			self.dispatch({name: data}, {name: sink})
+
+
+	def start(self, collectors, processors, sinks):
+		ts = self.time_func()
+		for name, collector in collectors.viewitems():
+			interval = self.interval('collectors', name)
+			log.debug('Collector schedule (name: {}): {}s'.format(name, interval))
+			self.schedule(ts, interval, self.prio_collect, self.collect, name, collector)
+		self.schedule( ts, self.interval('processing'),
+			self.prio_process, self.process_queue, self.chain(processors), sinks )
+		for name, sink in sinks.viewitems():
+			interval = self.interval('sinks', name)
+			log.debug('Sink schedule (name: {}): {}s'.format(name, interval))
+			self.schedule(ts, interval, self.prio_dispatch, self.flush, name, sink)
+		self.sched.run()
+
+
+loop = ScheduledLoop
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+import itertools as it, operator as op, functools as ft
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+
+from graphite_metrics.collectors import DatapointBatch
+from .basic import BasicLoop
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class ThreadedLoop(BasicLoop):
+
+	'''Same as BasicLoop, but polls collectors concurrently
+			on a bounded pool of worker threads, so that cycle takes
+			as long as the slowest collector, not the sum of all of them.
+		Collectors that don't return within a timeout get their cycle dropped,
+			and are not polled again until the hung read() call returns.'''
+
+	def __init__(self, *argz, **kwz):
+		super(ThreadedLoop, self).__init__(*argz, **kwz)
+		self.pool = ThreadPool(self.conf.get('threads') or None)
+		self.timeouts = self.conf.get('collector_timeouts') or dict()
+		self.pending = dict() # reads from previous cycles that timed out
+
+	def timeout(self, name):
+		timeout = self.timeouts.get(name)
+		if timeout is None: timeout = self.conf.get('collector_timeout')
+		if timeout is None: timeout = self.conf.interval
+		return timeout
+
+	def poll(self, collectors):
+		ts, polls = self.time_func(), list()
+		for name, collector in collectors.viewitems():
+			res = self.pending.get(name)
+			if res is not None:
+				if not res.ready():
+					log.warn(( 'Collector (name: {}) is still stuck'
+						' in previous read() call, skipping it' ).format(name))
+					continue
+				del self.pending[name] # late result is discarded
+			log.debug('Polling data from a collector (name: {}): {}'.format(name, collector))
+			polls.append((name, collector, self.pool.apply_async(
+				self.call, ['collectors', name, None, collector.read_batch] )))
+
+		data = DatapointBatch()
+		for name, collector, res in polls:
+			try: data.extend(res.get(max(0, ts + self.timeout(name) - self.time_func())))
+			except TimeoutError:
+				log.error(( 'Timed-out polling collector (name: {}, obj: {},'
+					' timeout: {}s), dropping its cycle' ).format(name, collector, self.timeout(name)))
+				self.pending[name] = res
+			except Exception as err:
+				log.exception( 'Failed to poll collector'
+					' (name: {}, obj: {}): {}'.format(name, collector, err) )
+		return data
+
+
+loop = ThreadedLoop
@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
 
 import itertools as it, operator as op, functools as ft
+from array import array
+
+from graphite_metrics.collectors import DatapointBatch
 
 import logging
 log = logging.getLogger(__name__)
@@ -15,3 +18,24 @@ class Processor(object):
 		raise NotImplementedError( 'Processor.process method'
 			' should be overidden in processor subclasses to mangle'
 			' (name, value, timestamp) tuple in some way.' )
+
+	def process_batch(self, batch, routes, sinks):
+		'''Processes DatapointBatch of all datapoints for a cycle at once.
+			"routes" is a dict of sink names to row masks (None for "all rows"),
+				which can be modified to drop datapoints from being sent to a particular sink,
+				"sinks" is a dict of sink names to objects.
+			Returns new (or same, updated in-place) batch and routes.
+			Default implementation passes each datapoint through process() method.'''
+		res, res_routes = DatapointBatch(), dict((name, array('B')) for name in routes)
+		for n, dp in enumerate(batch.tuples()):
+			dp_sinks = dict( (name, sinks[name])
+				for name, mask in routes.viewitems() if mask is None or mask[n] )
+			try: dp, dp_sinks = self.process(dp, dp_sinks)
+			except Exception as err:
+				log.exception(( 'Failed to process datapoint (data: {},'
+					' processor: {}): {}, discarding' ).format(dp, self, err))
+				continue
+			if dp is None: continue
+			res.append(dp[0], 'gauge', dp[1], dp[2])
+			for name, mask in res_routes.viewitems(): mask.append(name in dp_sinks)
+		return res, res_routes
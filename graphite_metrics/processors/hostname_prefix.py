@@ -23,5 +23,9 @@ class HostnamePrefix(Processor):
 		name, value, ts_dp = dp_tuple
 		return (self.prefix + name, value, ts_dp), sinks
 
+	def process_batch(self, batch, routes, sinks):
+		batch.names = map(self.prefix.__add__, batch.names)
+		return batch, routes
+
 
 processor = HostnamePrefix
@@ -14,3 +14,8 @@ class Sink(object):
 	def dispatch(self, *tuples):
 		raise NotImplementedError( 'Sink.dispatch method should be overidden in sink'
 			' subclasses to dispatch (metric_name, value, timestamp) tuples to whatever destination.' )
+
+	def dispatch_batch(self, batch):
+		'''Dispatches DatapointBatch of processed values,
+			passing its (name, value, timestamp) tuples to dispatch() by default.'''
+		self.dispatch(*batch.tuples())
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+
+import itertools as it, operator as op, functools as ft
+from Queue import Queue, Full, Empty
+from threading import Thread, Lock
+from time import time, sleep
+from io import open
+import os, atexit
+
+from .carbon_socket import CarbonSocket
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class CarbonBuffered(CarbonSocket):
+
+	'''Non-blocking sender to graphite carbon tcp linereceiver interface.
+		All network i/o is done from a background thread, fed from a bounded queue.
+		Data that doesn't fit into the queue (e.g. during carbon outage) is appended
+			to an on-disk spool, which gets replayed (with a rate limit) whenever queue is empty.'''
+
+	lazy_connect = True # no connect() from the main thread
+
+	def __init__(self, conf):
+		super(CarbonBuffered, self).__init__(conf)
+		self.chunk_size = max(1, self.conf.buffer.chunk_size)
+		self.queue = Queue(max(1, self.conf.buffer.queue_size // self.chunk_size))
+
+		self.spool_lock, self.spool_path = Lock(), self.conf.spool.path
+		self.spool_repair()
+		self.spool = open(self.spool_path, 'ab')
+		self.spool_src, self.spool_pos = open(self.spool_path, 'rb'), 0
+		self.spool_size = os.fstat(self.spool.fileno()).st_size
+		if self.spool_size:
+			log.info( 'Found {}B of data in spool,'
+				' will be replayed: {}'.format(self.spool_size, self.spool_path) )
+		atexit.register(self.spool_queue)
+
+		if not self.conf.debug.dry_run:
+			self.writer = Thread(target=self.writer_loop, name='carbon_buffered')
+			self.writer.daemon = True
+			self.writer.start()
+
+
+	def spool_repair(self, block=2**16):
+		'Truncates partial line (e.g. left after crash) at the end of spool file, if any.'
+		try: spool = open(self.spool_path, 'r+b')
+		except (OSError, IOError): return # will be created or fail on open() for append
+		with spool:
+			size = pos = os.fstat(spool.fileno()).st_size
+			if not size: return
+			spool.seek(size - 1)
+			if spool.read(1) == '\n': return
+			while pos > 0:
+				n = max(0, pos - block)
+				spool.seek(n)
+				n_nl = spool.read(pos - n).rfind('\n')
+				if n_nl >= 0:
+					pos = n + n_nl + 1
+					break
+				pos = n
+			log.warn(( 'Discarding partial line at the end'
+				' of spool ({}): {}B' ).format(self.spool_path, size - pos))
+			spool.truncate(pos)
+
+	def spool_write(self, tuples):
+		packet = self.serialize_lines(tuples)
+		with self.spool_lock:
+			if self.conf.spool.max_size\
+					and self.spool_size + len(packet) > self.conf.spool.max_size:
+				log.error(( 'Spool size limit ({}B) reached, discarding'
+					' {} datapoints' ).format(self.conf.spool.max_size, len(tuples)))
+				return
+			self.spool.write(packet)
+			self.spool.flush()
+			self.spool_size += len(packet)
+
+	def spool_read(self, count):
+		with self.spool_lock:
+			if self.spool_pos >= self.spool_size: return None
+			self.spool_src.seek(self.spool_pos)
+			tuples = list()
+			for line in iter(self.spool_src.readline, ''):
+				try:
+					name, value, ts = line.split()
+					tuples.append((name, float(value), int(ts)))
+				except ValueError:
+					log.warn('Skipping malformed line in spool: {!r}'.format(line))
+					continue
+				if len(tuples) >= count: break
+			self.spool_pos = self.spool_src.tell()
+			if self.spool_pos >= self.spool_size:
+				log.debug('Spool was fully replayed, truncating it')
+				self.spool.truncate(0)
+				self.spool_src.close() # to drop any buffered data
+				self.spool_src = open(self.spool_path, 'rb')
+				self.spool_size = self.spool_pos = 0
+			return tuples
+
+	def spool_queue(self):
+		while True:
+			try: self.spool_write(self.queue.get_nowait())
+			except Empty: break
+
+
+	def send(self, conn, tuples):
+		try: super(CarbonBuffered, self).send(conn, tuples)
+		except Exception as err:
+			log.error(( 'Failed to send {} datapoints to Carbon'
+				' ({}), spooling these: {}' ).format(len(tuples), conn, err))
+			conn.close()
+			self.spool_write(tuples)
+			if self.conf.reconnect_delay: sleep(max(0, self.conf.reconnect_delay))
+
+	def writer_loop(self):
+		rate, ts_replay = self.conf.spool.replay_rate, 0
+		batch = min(self.chunk_size, rate or self.chunk_size)
+		while True:
+			try:
+				try: tuples = self.queue.get_nowait()
+				except Empty:
+					tuples = self.spool_read(batch)
+					if not tuples: tuples = self.queue.get()
+					elif rate:
+						sleep(max(0, ts_replay - time()))
+						ts_replay = time() + len(tuples) / float(rate)
+				super(CarbonBuffered, self).dispatch(*tuples)
+			except Exception:
+				log.exception('Unhandled error in carbon_buffered writer thread, ignoring')
+				if self.conf.reconnect_delay: sleep(max(0, self.conf.reconnect_delay))
+
+	def dispatch(self, *tuples):
+		for n in xrange(0, len(tuples), self.chunk_size):
+			try: self.queue.put_nowait(tuples[n:n+self.chunk_size])
+			except Full:
+				log.debug('Send queue is full, spooling {} datapoints'.format(len(tuples) - n))
+				self.spool_write(tuples[n:])
+				break
+
+
+sink = CarbonBuffered
@@ -1,8 +1,11 @@
 # -*- coding: utf-8 -*-
 
 import itertools as it, operator as op, functools as ft
+from multiprocessing.pool import ThreadPool
+from cPickle import dumps
+from hashlib import md5
 from time import sleep
-import socket
+import socket, struct, bisect, types
 
 from . import Sink
 
@@ -10,29 +13,54 @@ import logging
 log = logging.getLogger(__name__)
 
 
-class CarbonSocket(Sink):
+class ConsistentHashRing(object):
 
-	'''Simple blocking non-buffering sender
-		to graphite carbon tcp linereceiver interface.'''
+	'''Same consistent hashing as used in carbon-relay
+			("consistent-hashing" relay method), to route metrics to the same
+			carbon-cache instances as the relay would, given the same destinations.
+		Nodes are (server, instance) tuples, as in carbon.'''
 
-	def __init__(self, conf):
-		super(CarbonSocket, self).__init__(conf)
-		if not self.conf.debug.dry_run: self.connect()
+	def __init__(self, nodes, replica_count=100):
+		self.ring = list()
+		for node in nodes:
+			for n in xrange(replica_count):
+				bisect.insort(self.ring, (self.position('{}:{}'.format(node, n)), node))
+
+	@staticmethod
+	def position(key): return int(md5(key).hexdigest()[:4], 16)
+
+	def get_node(self, key):
+		n = bisect.bisect_left(self.ring, (self.position(key), None)) % len(self.ring)
+		return self.ring[n][1]
+
+
+class CarbonConnection(object):
+
+	'Persistent blocking connection to a single carbon daemon.'
+
+	sock = None
+
+	def __init__(self, host, conf):
+		self.host, self.conf = host, conf
+
+	def __repr__(self): return '<CarbonConnection {0[0]}:{0[1]}>'.format(self.host)
 
 	def connect(self, send=None):
 		reconnects = self.conf.max_reconnects
 		while True:
 			self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 			try:
-				self.sock.connect(self.conf.host)
-				log.debug('Connected to Carbon at {}:{}'.format(*self.conf.host))
+				self.sock.connect(self.host)
+				log.debug('Connected to Carbon at {}:{}'.format(*self.host))
 				if send: self.sock.sendall(send)
 			except socket.error as err:
 				if reconnects is not None:
 					reconnects -= 1
-					if reconnects <= 0: raise
+					if reconnects <= 0:
+						self.close()
+						raise
 				log.info( 'Failed to connect to'
-					' {0[0]}:{0[1]}: {1}'.format(self.conf.host, err) )
+					' {0[0]}:{0[1]}: {1}'.format(self.host, err) )
 				if self.conf.reconnect_delay:
 					sleep(max(0, self.conf.reconnect_delay))
 			else: break
@@ -40,18 +68,105 @@ class CarbonSocket(Sink):
 	def close(self):
 		try: self.sock.close()
 		except: pass
+		self.sock = None
 
 	def reconnect(self, send=None):
 		self.close()
 		self.connect(send=send)
 
-	def dispatch(self, *tuples):
-		reconnects = self.conf.max_reconnects
-		packet = ''.join(it.starmap('{} {} {}\n'.format, tuples))
+	def send(self, packet):
+		if not self.sock: return self.connect(send=packet)
 		try: self.sock.sendall(packet)
 		except socket.error as err:
 			log.error('Failed to send data to Carbon server: {}'.format(err))
 			self.reconnect(send=packet)
 
 
+class CarbonSocket(Sink):
+
+	'''Simple blocking non-buffering sender
+			to graphite carbon tcp linereceiver (or pickle receiver) interface.
+		If several destinations are specified, metrics are routed between
+			these via consistent hashing, same as carbon-relay does it,
+			with data sent to all destinations concurrently.'''
+
+	lazy_connect = False
+
+	def __init__(self, conf):
+		super(CarbonSocket, self).__init__(conf)
+		assert self.conf.get('protocol', 'line') in ['line', 'pickle']
+		self.pickle = self.conf.get('protocol') == 'pickle'
+
+		if self.conf.get('destinations'):
+			dsts = map(self.destination, self.conf.destinations)
+		else:
+			host, port = self.conf.host
+			if port is None:
+				port = self.conf.pickle_port if self.pickle else self.conf.default_port
+			dsts = [((host, port), None)]
+		self.conns = dict()
+		for host, instance in dsts:
+			if (host[0], instance) in self.conns: # same as carbon ConsistentHashingRouter
+				raise ValueError(( 'Duplicate carbon destination (server, instance)'
+					' pair: {!r}, specify unique instance for each one' ).format((host[0], instance)))
+			self.conns[host[0], instance] = CarbonConnection(host, self.conf)
+		if len(self.conns) > 1:
+			self.ring = ConsistentHashRing(self.conns)
+			self.pool = ThreadPool(len(self.conns))
+		else: self.ring = None
+
+		if not self.conf.debug.dry_run and not self.lazy_connect: self.connect()
+
+	def destination(self, spec):
+		'''Returns ((host, port), instance) tuple for a
+			"host[:port[:instance]]" spec, as used in carbon DESTINATIONS.'''
+		if not isinstance(spec, types.StringTypes): spec = ':'.join(map(bytes, spec))
+		spec = spec.split(':', 2)
+		host = spec[0]
+		port = int(spec[1]) if len(spec) > 1 and spec[1] else\
+			(self.conf.pickle_port if self.pickle else self.conf.default_port)
+		instance = spec[2] if len(spec) > 2 else None
+		return (host, port), instance
+
+	def connect(self):
+		for conn in self.conns.viewvalues(): conn.connect()
+
+	def close(self):
+		for conn in self.conns.viewvalues(): conn.close()
+
+
+	@staticmethod
+	def serialize_lines(tuples):
+		return ''.join(it.starmap('{} {} {}\n'.format, tuples))
+
+	def serialize_pickle(self, tuples, _len=struct.Struct('!L').pack):
+		frames, size = list(), self.conf.pickle_batch_size
+		for n in xrange(0, len(tuples), size):
+			frame = dumps([(name, (ts, value)) for name, value, ts in tuples[n:n+size]], 2)
+			frames.extend([_len(len(frame)), frame])
+		return ''.join(frames)
+
+	def serialize(self, tuples):
+		return self.serialize_pickle(tuples)\
+			if self.pickle else self.serialize_lines(tuples)
+
+
+	def route(self, tuples):
+		if not self.ring: return [(next(self.conns.itervalues()), tuples)]
+		routes, get_node = dict(), self.ring.get_node
+		for dp in tuples:
+			node = get_node(dp[0])
+			try: routes[node].append(dp)
+			except KeyError: routes[node] = [dp]
+		return list((self.conns[node], dps) for node, dps in routes.viewitems())
+
+	def send(self, conn, tuples):
+		conn.send(self.serialize(tuples))
+
+	def dispatch(self, *tuples):
+		routes = self.route(tuples)
+		if len(routes) == 1: self.send(*routes[0])
+		else: self.pool.map(lambda route: self.send(*route), routes)
+
+
 sink = CarbonSocket
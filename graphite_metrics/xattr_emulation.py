@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+import itertools as it, operator as op, functools as ft
+from time import time
+import os, sys, errno, struct, types, atexit
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class XattrStore(object):
+
+	'''Persistent storage for emulated xattrs (see install() below).
+		All values are kept in memory, with updates appended as records to a log file,
+			which is only written and fsync'ed once per flush_interval (on access) and on exit.
+		Log gets compacted (atomically re-written with only the latest values)
+			when it grows to more than compact_ratio times the size of these.
+		Partially-written record at the end of the log (e.g. after crash) is discarded.'''
+
+	magic, record = 'gmx1', struct.Struct('=II') # key length, value length
+	compact_min = 2**16 # bytes
+
+	def __init__(self, path, flush_interval=60, compact_ratio=4):
+		self.path, self.flush_interval, self.compact_ratio = path, flush_interval, compact_ratio
+		self.data, self.pending, self.log_size = dict(), dict(), 0
+		self.flush_ts = time() + (flush_interval or 0)
+		self.load()
+		atexit.register(self.flush)
+
+	def __getitem__(self, k):
+		self.flush_check()
+		return self.data[k]
+
+	def __setitem__(self, k, v):
+		if self.data.get(k) == v: return
+		self.data[k] = self.pending[k] = v
+		self.flush_check()
+
+	def load(self):
+		try: src = open(self.path, 'rb')
+		except (OSError, IOError) as err:
+			if err.errno != errno.ENOENT: raise
+			return self.migrate()
+		with src:
+			if src.read(len(self.magic)) != self.magic:
+				src.close()
+				return self.migrate()
+			pos, size = src.tell(), os.fstat(src.fileno()).st_size
+			while pos + self.record.size <= size:
+				k_len, v_len = self.record.unpack(src.read(self.record.size))
+				if pos + self.record.size + k_len + v_len > size: break
+				k = src.read(k_len)
+				self.data[k] = src.read(v_len)
+				pos += self.record.size + k_len + v_len
+		self.log_size = pos
+		if pos < size:
+			log.warn(( 'Discarding partial record at the end'
+				' of xattr emulation db ({}): {}B' ).format(self.path, size - pos))
+			with open(self.path, 'r+b') as dst: dst.truncate(pos)
+		log.debug('Loaded {} emulated xattr value(s) from: {}'.format(len(self.data), self.path))
+
+	def migrate(self):
+		'Imports values from shelve db, used for xattr emulation in older versions, if any.'
+		import shelve
+		try: db = shelve.open(self.path, 'r')
+		except Exception: return # no such db or different format
+		try: self.data.update((k, db[k]) for k in db.keys())
+		finally: db.close()
+		log.info('Imported {} value(s) from shelve db: {}'.format(len(self.data), self.path))
+		self.compact()
+
+	def _records(self, items):
+		return ''.join(
+			self.record.pack(len(k), len(v)) + k + v for k, v in items )
+
+	def compact(self):
+		log.debug('Compacting xattr emulation db: {}'.format(self.path))
+		data = self.magic + self._records(self.data.viewitems())
+		with open('{}.tmp'.format(self.path), 'wb') as dst:
+			dst.write(data)
+			dst.flush()
+			os.fsync(dst.fileno())
+		os.rename('{}.tmp'.format(self.path), self.path)
+		self.log_size, self.pending = len(data), dict()
+
+	def flush_check(self):
+		if self.pending and time() >= self.flush_ts: self.flush()
+
+	def flush(self):
+		self.flush_ts = time() + (self.flush_interval or 0)
+		if not self.pending: return
+		data, self.pending = self._records(self.pending.viewitems()), dict()
+		size = len(self.magic) + sum( self.record.size
+			+ len(k) + len(v) for k, v in self.data.viewitems() )
+		if not self.log_size\
+				or self.log_size + len(data) > max(self.compact_min, size * self.compact_ratio):
+			return self.compact() # also replaces missing or unrecognized file
+		with open(self.path, 'ab') as dst:
+			dst.write(data)
+			dst.flush()
+			os.fsync(dst.fileno())
+		self.log_size += len(data)
+
+
+def install(path, flush_interval=60):
+	'''Replaces "xattr" module with a fake one, storing values in XattrStore,
+		which is returned. Files are identified by their path (name of file object).'''
+	store = XattrStore(path, flush_interval=flush_interval)
+
+	class xattr_path(object):
+		def __init__(self, base):
+			if not isinstance(base, types.StringTypes): base = base.name
+			self.base = base
+		def key(self, k): return '{}\0{}'.format(self.base, k)
+		def __setitem__(self, k, v): store[self.key(k)] = v
+		def __getitem__(self, k): return store[self.key(k)]
+
+	class xattr_module(object): xattr = xattr_path
+	sys.modules['xattr'] = xattr_module
+	return store
@@ -8,7 +8,9 @@ from setuptools import setup, find_packages
 
 pkg_root = os.path.dirname(__file__)
 
-entry_points = dict(console_scripts=['harvestd = graphite_metrics.harvestd:main'])
+entry_points = dict(console_scripts=[
+	'harvestd = graphite_metrics.harvestd:main',
+	'harvestd-bench = graphite_metrics.bench:main' ])
 entry_points.update(
 	('graphite_metrics.{}'.format(ep_type), list(
 		'{0} = graphite_metrics.{1}.{0}'\